@@ -0,0 +1,398 @@
+import asyncio
+import struct
+import timeit
+import click
+from typing import Dict, List, Sequence, Tuple
+from motor.pkt import *
+from motor.protocol import MotorProtocol
+from motor.motor import Motor, RotateTiltMotor
+from motor.sim import SimMotor, create_sim_connection
+from motor.capture import CaptureWriter, EXPIRE, RX, TX, read_capture
+from motor.frame import FrameParser, split_requests
+from motor.replay import Replayer
+from typing import Optional
+
+
+def _legacy_serialize(id: int, flag: int, data: bytes):
+    # `serialize` as it was before the structs were precompiled
+    assert id >= 0 and id <= 255
+    fmt: str
+    import sys
+    if sys.version_info >= (3, 10):
+        match get_flag_width(flag):
+            case FlagWidth.CHAR:
+                fmt = ">BB{}s".format(len(data))
+            case FlagWidth.SHORT:
+                fmt = ">BH{}s".format(len(data))
+            case _:
+                raise ValueError("invalid flag: {}".format(flag))
+    else:
+        if flag <= 0xff:
+            fmt = ">BB{}s".format(len(data))
+        elif flag <= 0xffff:
+            fmt = ">BH{}s".format(len(data))
+        else:
+            raise ValueError("invalid flag: {}".format(flag))
+    return struct.pack(fmt, id, flag, data)
+
+
+def _legacy_read_position_pkt(id: int):
+    return _legacy_serialize(id, READ_POSITION, b'')
+
+
+def _legacy_ctrl_speed_with_pulse_count_pkt(id: int, direction: Direction, speed: int, pulse_count: int):
+    assert (speed >= 0 and speed < 128)
+    s = ((direction.value & 0x01) << 7) | (speed & 0xff)
+    data = struct.pack('>BH', s, pulse_count)
+    return _legacy_serialize(id, CTRL_SPEED_WITH_PULSE_CNT, data)
+
+
+async def _legacy_read_position(protocol: MotorProtocol, id: int, timeout: Optional[float]):
+    # `read_position` as it was: closures per read through the generic wrappers
+    def fn(timeout: float): return protocol.read_wrapper(id, READ_POSITION, lambda: protocol.write(read_position_pkt(id)),
+                                                         lambda res: struct.unpack("!Bi", res)[1], timeout=timeout)
+    return await protocol.retry_read_wrapper(id, fn, timeout, 3)
+
+
+def _rate(fn, number: int) -> float:
+    # best of 5, in packets per second
+    return number / min(timeit.repeat(fn, number=number, repeat=5))
+
+
+def _percentiles(xs: List[float], ps: Sequence[int] = (50, 90, 99)) -> str:
+    xs = sorted(xs)
+    return " ".join("p{}:{:.2f}ms".format(p, xs[min(len(xs) - 1, len(xs) * p // 100)] * 1e3) for p in ps)
+
+
+async def _bench_sim(number: int, baudrate: int, loss: float, timeout: Optional[float], capture: Optional[str]):
+    from loguru import logger
+    logger.remove()
+    loop = asyncio.get_running_loop()
+    ROTATE, TILT = 0xe0, 0xe1
+    recorder = CaptureWriter(capture) if capture else None
+    transport, protocol = await create_sim_connection(
+        loop, lambda: MotorProtocol(recorder=recorder), [SimMotor(ROTATE), SimMotor(TILT)], baudrate=baudrate, loss=loss, seed=0)
+    rotate, tilt = Motor(ROTATE, protocol), Motor(TILT, protocol)
+    gimbal = RotateTiltMotor(rotate, tilt)
+    await gimbal.get_degree()
+
+    async def timed_reads(read, reads_per_call: int = 1) -> None:
+        latencies: List[float] = []
+        failed = 0
+        start = loop.time()
+        for _ in range(number):
+            t = loop.time()
+            try:
+                await read()
+                latencies.append(loop.time() - t)
+            except IOError:
+                failed += 1
+        elapsed = loop.time() - start
+        click.echo("  {:.0f} reads/s {} failed:{}".format(
+            number * reads_per_call / elapsed, _percentiles(latencies) if latencies else "", failed))
+
+    click.echo("read_position, one axis")
+    await timed_reads(lambda: protocol.read_position(ROTATE, timeout=timeout, max_retry_times=1))
+    click.echo("get_degree, both axes pipelined")
+    await timed_reads(lambda: gimbal.get_degree(timeout=timeout, max_retry_times=1), 2)
+
+    start = loop.time()
+    for i in range(number):
+        await gimbal.delta_degree(100, 0.1 if i % 2 else -0.1, 0.1)
+    # wait for the last packet to leave the host
+    await asyncio.sleep(max(transport.tx_free_at - loop.time(), 0))
+    elapsed = loop.time() - start
+    click.echo("delta_degree, both axes batched\n  {:.0f} commands/s ({} bytes on the wire)".format(
+        2 * number / elapsed, transport.bytes_written))
+
+    click.echo("round trip times")
+    for id, latency in protocol.policy.histograms().items():
+        click.echo("  [{:02x}] {} timeout:{:.2f}ms".format(
+            id, latency, protocol.policy.timeout(id) * 1e3))
+
+    # a device that is configured but not on the bus
+    MISSING = 0xe2
+    missing = Motor(MISSING, protocol)
+    costs = []
+    for _ in range(5):
+        t = loop.time()
+        try:
+            await missing.get_degree(timeout=timeout)
+        except IOError:
+            pass
+        costs.append("{:.1f}ms".format((loop.time() - t) * 1e3))
+    click.echo("get_degree, missing device\n  " + " ".join(costs))
+
+    if recorder is not None:
+        # let the last replies in
+        await asyncio.sleep(protocol.policy.max_timeout)
+        recorder.close()
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--number", "-n", default=200000, help='Packets per round')
+def pkt(number: int):
+    """packets/s of the packet encoders, before and after"""
+    ID = 0xe0
+    buf = bytearray(64)
+    cases = [
+        ("read_position (legacy)", lambda: _legacy_read_position_pkt(ID)),
+        ("read_position (cached)", lambda: read_position_pkt(ID)),
+        ("speed_with_pulse_count (legacy)",
+         lambda: _legacy_ctrl_speed_with_pulse_count_pkt(ID, Direction.CCW, 100, 3200)),
+        ("speed_with_pulse_count (struct)",
+         lambda: ctrl_speed_with_pulse_count_pkt(ID, Direction.CCW, 100, 3200)),
+        ("speed_with_pulse_count (pack_into)",
+         lambda: ctrl_speed_with_pulse_count_pkt_into(buf, 0, ID, Direction.CCW, 100, 3200)),
+    ]
+    for name, fn in cases:
+        click.echo("{:<36} {:>12,.0f} pkt/s".format(name, _rate(fn, number)))
+
+
+@cli.command()
+@click.option("--number", "-n", default=2000, help='Operations per case')
+@click.option("--baudrate", "-b", default=38400, help='Baudrate')
+@click.option("--loss", default=0.0, help='Probability to lose a request')
+@click.option("--timeout", default=None, type=float, help='Read timeout in seconds, adaptive by default')
+@click.option("--capture", default=None, help='Record the traffic to this file')
+def sim(number: int, baudrate: int, loss: float, timeout: Optional[float], capture: Optional[str]):
+    """throughput and read latency through the protocol stack on simulated controllers"""
+    asyncio.run(_bench_sim(number, baudrate, loss, timeout, capture))
+
+
+async def _check_status(number: int, speed: int, degree: float):
+    from loguru import logger
+    logger.remove()
+    loop = asyncio.get_running_loop()
+    ID = 0xe0
+    sim_motor = SimMotor(ID)
+    _, protocol = await create_sim_connection(
+        loop, MotorProtocol, [sim_motor], status_replies=True, seed=0)
+    motor = Motor(ID, protocol)
+    await motor.get_degree()
+    wrong = 0
+    for i in range(number):
+        before = sim_motor.reading(loop.time())
+        motor.delta_degree(speed, degree if i % 2 == 0 else -degree / 2)
+        # the move is on the wire and the controller answered its start
+        await asyncio.sleep(0.01)
+        after = int(sim_motor._target * sim_motor.step_angle /  # type: ignore
+                    sim_motor.division / 360 * 65536) if sim_motor._target is not None else before
+        low, high = min(before, after), max(before, after)
+        # while moving (the finish frame comes in between), then standing
+        while True:
+            moving = sim_motor.moving(loop.time())
+            position = await protocol.read_position(ID)
+            encoder = await protocol.read_encoder(ID)
+            # the encoder is the position modulo a turn, read a little later
+            drift = (encoder - position) & 0xffff
+            ok = low <= position <= high and min(drift, 0x10000 - drift) < 0x1000
+            if not moving:
+                ok = ok and position == sim_motor.reading(loop.time())
+            if not ok:
+                wrong += 1
+                click.echo("move {}: read {} / {:04x}, expected {}..{}".format(
+                    i, position, encoder, low, high))
+            if not moving:
+                break
+    click.echo("{} moves, {} wrong readings".format(number, wrong))
+    if wrong:
+        raise click.ClickException("status frames taken for read replies")
+
+
+@cli.command()
+@click.option("--number", "-n", default=20, help='Moves')
+@click.option("--speed", default=20, help='Speed level of the moves')
+@click.option("--degree", default=30.0, help='Degrees per move')
+def status(number: int, speed: int, degree: float):
+    """check that the start and finish status frames of the moves don't break the reads on a simulated line"""
+    asyncio.run(_check_status(number, speed, degree))
+
+
+async def _check_gap(gap: float):
+    from loguru import logger
+    logger.remove()
+    loop = asyncio.get_running_loop()
+    ROTATE, TILT = 0xe0, 0xe1
+    transport, protocol = await create_sim_connection(
+        loop, lambda: MotorProtocol(inter_frame_gap=gap), [SimMotor(ROTATE), SimMotor(TILT)], seed=0)
+    rotate, tilt = Motor(ROTATE, protocol), Motor(TILT, protocol)
+    # (start, end) of every write on the wire
+    wire: List[Tuple[float, float]] = []
+    write = transport.write
+
+    def timed_write(data: bytes):
+        start = max(loop.time(), transport.tx_free_at)
+        write(data)
+        wire.append((start, transport.tx_free_at))
+    transport.write = timed_write  # type: ignore
+
+    cases = [
+        ("two single writes", lambda: (rotate.delta_degree(10, 1), tilt.delta_degree(10, 1))),
+        ("two one frame batches", lambda: (_one_frame_batch(rotate), _one_frame_batch(tilt))),
+        ("a batch of two", lambda: _both(rotate, tilt)),
+        ("a read behind a batch", lambda: (_both(rotate, tilt), asyncio.ensure_future(rotate.get_degree()))),
+    ]
+    failed = False
+    for name, send in cases:
+        wire.clear()
+        send()
+        await asyncio.sleep(0.1)
+        idle = [b[0] - a[1] for a, b in zip(wire, wire[1:])]
+        ok = len(idle) > 0 and min(idle) >= gap - 1e-9
+        failed = failed or not ok
+        click.echo("{:<24} {} writes, smallest idle time {:.3f}ms{}".format(
+            name, len(wire), min(idle) * 1e3 if idle else float("nan"), "" if ok else " (too short)"))
+    if failed:
+        raise click.ClickException("frames sent within the inter frame gap")
+
+
+def _one_frame_batch(motor: Motor):
+    with motor.protocol.batch():
+        motor.delta_degree(10, 1)
+
+
+def _both(rotate: Motor, tilt: Motor):
+    with rotate.protocol.batch():
+        rotate.delta_degree(10, 1)
+        tilt.delta_degree(10, 1)
+
+
+@cli.command()
+@click.option("--gap", default=0.002, help='Inter frame gap in seconds')
+def gap(gap: float):
+    """check on a simulated line that every frame is followed by the inter frame gap"""
+    asyncio.run(_check_gap(gap))
+
+
+async def _bench_reads(number: int, concurrency: int):
+    from loguru import logger
+    logger.remove()
+    loop = asyncio.get_running_loop()
+    ID = 0xe0
+    # a line fast enough for the host side to be the bottleneck
+    _, protocol = await create_sim_connection(
+        loop, MotorProtocol, [SimMotor(ID)], baudrate=100_000_000, response_delay=0)
+    protocol.register_device(ID)
+    cases = [
+        ("closures (legacy)", lambda: _legacy_read_position(protocol, ID, None)),
+        ("read_position", lambda: protocol.read_position(ID)),
+    ]
+    for name, read in cases:
+        best = float("inf")
+        for _ in range(5):
+            start = loop.time()
+            for _ in range(number // concurrency):
+                await asyncio.gather(*(read() for _ in range(concurrency)))
+            best = min(best, loop.time() - start)
+        click.echo("{:<20} {:>10,.0f} reads/s".format(
+            name, number // concurrency * concurrency / best))
+
+
+@cli.command()
+@click.option("--number", "-n", default=20000, help='Reads per round')
+@click.option("--concurrency", "-c", default=1, help='Reads in flight at once')
+def reads(number: int, concurrency: int):
+    """reads/s of the read path itself, on a simulated line with no transfer time"""
+    asyncio.run(_bench_reads(number, concurrency))
+
+
+async def _check_replay(number: int, loss: float):
+    import os
+    import tempfile
+    from loguru import logger
+    logger.remove()
+    loop = asyncio.get_running_loop()
+    ROTATE, TILT = 0xe0, 0xe1
+    path = os.path.join(tempfile.mkdtemp(), "lossy.cap")
+    recorder = CaptureWriter(path)
+    _, protocol = await create_sim_connection(
+        loop, lambda: MotorProtocol(recorder=recorder), [SimMotor(ROTATE), SimMotor(TILT)], loss=loss, seed=0)
+    gimbal = RotateTiltMotor(Motor(ROTATE, protocol), Motor(TILT, protocol))
+    # the lost moves drift for real: the replay must find the same drift
+    live: Dict[int, List[float]] = {ROTATE: [], TILT: []}
+    for i in range(number):
+        for motor in (gimbal.rotate_motor, gimbal.tilt_motor):
+            estimated = motor.last_position_deg
+            try:
+                measured = await motor.get_degree(max_retry_times=1)
+            except IOError:
+                continue
+            if estimated is not None:
+                live[motor.id].append(measured - estimated)
+        await gimbal.delta_degree(100, 0.1 if i % 2 else -0.1, 0.1)
+    # let the last replies in, or their reads expire
+    await asyncio.sleep(protocol.policy.max_timeout)
+    recorder.close()
+    stats = await Replayer().run(path)
+    os.remove(path)
+    worst = 0.0
+    for id, drift in live.items():
+        replayed = stats.drift.get(id, [])
+        if len(replayed) != len(drift):
+            raise click.ClickException("[{:02x}] {} readings replayed, {} live".format(
+                id, len(replayed), len(drift)))
+        worst = max([worst] + [abs(a - b) for a, b in zip(replayed, drift)])
+    click.echo("{} replies, {} requests expired, worst difference to the live drift {:.3f} deg".format(
+        stats.replies, stats.expired, worst))
+    if worst > 1e-6:
+        raise click.ClickException("the replay lost track of the requests")
+
+
+@cli.command("replay-check")
+@click.option("--number", "-n", default=300, help='Reads and moves per axis')
+@click.option("--loss", default=0.05, help='Probability to lose a request')
+def replay_check(number: int, loss: float):
+    """record a simulated run on a lossy line and check that its replay matches the replies to the same requests"""
+    asyncio.run(_check_replay(number, loss))
+
+
+@cli.command()
+@click.argument("path")
+@click.option("--realtime", is_flag=True, help='Keep the original timing')
+def replay(path: str, realtime: bool):
+    """replay a capture through the protocol and Motor, and time the frame parser on it"""
+    from loguru import logger
+    logger.remove()
+    records = list(read_capture(path))
+
+    stats = asyncio.run(Replayer().run(path, realtime))
+    click.echo("{} records, {} bytes sent, {} bytes received".format(
+        stats.records, stats.tx_bytes, stats.rx_bytes))
+    click.echo("{} replies, {} requests expired, {} unanswered".format(
+        stats.replies, stats.expired, stats.unanswered))
+    for id, drift in stats.drift.items():
+        worst = max(drift, key=abs)
+        click.echo("[{:02x}] {} position readings, worst drift {:.3f} deg".format(
+            id, len(drift), worst))
+
+    # the parser alone: expectations from the requests, then the replies
+    def parse():
+        parser = FrameParser()
+        n = 0
+        for record in records:
+            if record.direction == TX:
+                for frame in split_requests(record.data)[0]:
+                    parser.register(frame[0])
+                    if frame[1] in REPLY_SIZE:
+                        parser.expect(frame[0], frame[1])
+                    elif frame[1] == CTRL_SPEED_WITH_PULSE_CNT and frame[0] != BROADCAST_ADDR:
+                        parser.expect_status(frame[0])
+            elif record.direction == EXPIRE:
+                parser.discard(record.data[0], record.data[1])
+            else:
+                n += len(parser.feed(record.data))
+        return n
+    frames = parse()
+    best = min(timeit.repeat(parse, number=1, repeat=5))
+    click.echo("parser: {:.0f} frames/s, {:.2f} MB/s received data".format(
+        frames / best, stats.rx_bytes / best / 1e6))
+
+
+if __name__ == "__main__":
+    cli()
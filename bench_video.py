@@ -0,0 +1,424 @@
+import timeit
+import click
+import cv2
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+from camCfg import CaptureConfig
+
+
+def _synthetic_centers(n: int, size: Tuple[int, int] = (1280, 720)) -> List[Tuple[int, int]]:
+    # where `_synthetic_frames` draws the spot
+    w, h = size
+    return [(int(w / 2 + w / 4 * np.cos(i / 10)), int(h / 2 + h / 4 * np.sin(i / 10))) for i in range(n)]
+
+
+def _synthetic_background(size: Tuple[int, int] = (1280, 720), seed: int = 0) -> np.ndarray:
+    # textured, so that the JPEG isn't trivially small
+    w, h = size
+    rng = np.random.default_rng(seed)
+    return cv2.GaussianBlur(rng.integers(0, 255, (h, w, 3), dtype=np.uint8), (0, 0), 3)
+
+
+def _synthetic_frames(n: int, size: Tuple[int, int] = (1280, 720), seed: int = 0) -> List[np.ndarray]:
+    # a red laser spot going around on the background
+    background = _synthetic_background(size, seed)
+    frames = []
+    for x, y in _synthetic_centers(n, size):
+        frame = background.copy()
+        cv2.circle(frame, (x, y), 6, (150, 80, 255), -1)
+        frames.append(frame)
+    return frames
+
+
+def _to_yuyv(bgr: np.ndarray) -> np.ndarray:
+    # what a YUYV camera would send for `bgr`, as the 1 x N buffer of V4L2:
+    # BT.601 limited range, the inverse of `YUYVFrame.bgr`
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2YUV_YUYV).reshape(1, -1)
+
+
+def _frames(video: Optional[str], n: int) -> List[np.ndarray]:
+    if video is None:
+        return _synthetic_frames(n)
+    cap = cv2.VideoCapture(video)
+    frames = []
+    while len(frames) < n:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames.append(frame)
+    if not frames:
+        raise click.ClickException("no frame in {}".format(video))
+    return frames
+
+
+def _ms_per_frame(fn: Callable[[np.ndarray], object], frames: List[np.ndarray]) -> float:
+    def run():
+        for f in frames:
+            fn(f)
+    return min(timeit.repeat(run, number=1, repeat=5)) / len(frames) * 1e3
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones')
+@click.option("--number", "-n", default=60, help='Frames')
+def capture(video: Optional[str], number: int):
+    """ms/frame from the camera buffer to the working image, before and after"""
+    frames = _frames(video, number)
+    h, w = frames[0].shape[:2]
+    # what the camera hands over in MJPG mode
+    jpegs = [cv2.imencode(".jpg", f)[1].reshape(1, -1) for f in frames]
+    config = CaptureConfig(width=w, height=h)
+    out = np.empty(config.output_size[::-1] + (3,), dtype=np.uint8)
+
+    def legacy_decoded(img: np.ndarray):
+        img = img[140:-150, 420:-250]
+        return cv2.resize(img, (int(img.shape[1]/2), int(img.shape[0]/2)))
+
+    def legacy(jpeg: np.ndarray):
+        return legacy_decoded(cv2.imdecode(jpeg, cv2.IMREAD_COLOR))
+
+    cases = [
+        ("decode + slice + resize (legacy)", legacy, jpegs),
+        ("decode + area resize into buffer", lambda j: config.process(
+            cv2.imdecode(j, cv2.IMREAD_COLOR), out), jpegs),
+        ("reduced decode + crop", lambda j: config.process(j), jpegs),
+        ("decoded: slice + resize (legacy)", legacy_decoded, frames),
+        ("decoded: area resize into buffer",
+         lambda f: config.process(f, out), frames),
+    ]
+    for name, fn, inputs in cases:
+        click.echo("{:<36} {:>7.3f} ms/frame".format(
+            name, _ms_per_frame(fn, inputs)))
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones')
+@click.option("--number", "-n", default=60, help='Frames')
+def yuyv(video: Optional[str], number: int):
+    """ms/frame from the camera buffer to the laser spots, MJPG against raw YUYV"""
+    from video import extractByChroma, extractByThresh, extractByYUVLUT, find_laser_spots, find_laser_spots_yuyv, \
+        COLOR_MIN_RED, COLOR_MAX_RED, COLOR_MIN_RED_YUV, COLOR_MAX_RED_YUV, RED_YUV_LUT
+    frames = _frames(video, number)
+    h, w = frames[0].shape[:2]
+    jpegs = [cv2.imencode(".jpg", f)[1].reshape(1, -1) for f in frames]
+    raws = [_to_yuyv(f) for f in frames]
+    mjpg = CaptureConfig(width=w, height=h, scale=1)
+    yuyv = CaptureConfig(width=w, height=h, scale=1, fourcc="YUYV")
+
+    cases = [
+        ("MJPG: decode + LAB mask", lambda j: extractByThresh(
+            mjpg.process(j), COLOR_MIN_RED, COLOR_MAX_RED), jpegs),
+        ("YUYV: chroma mask", lambda r: extractByChroma(
+            yuyv.process(r), COLOR_MIN_RED_YUV, COLOR_MAX_RED_YUV), raws),
+        ("YUYV: chroma LUT mask", lambda r: extractByYUVLUT(
+            yuyv.process(r), RED_YUV_LUT), raws),
+        ("MJPG: decode + find_laser_spots",
+         lambda j: find_laser_spots(mjpg.process(j)), jpegs),
+        ("YUYV: find_laser_spots_yuyv",
+         lambda r: find_laser_spots_yuyv(yuyv.process(r)), raws),
+    ]
+    for name, fn, inputs in cases:
+        click.echo("{:<36} {:>7.3f} ms/frame".format(
+            name, _ms_per_frame(fn, inputs)))
+    # both should see the same spots
+    worst = 0.0
+    for j, r in zip(jpegs, raws):
+        a, b = find_laser_spots(mjpg.process(j)), find_laser_spots_yuyv(yuyv.process(r))
+        if len(a) != len(b):
+            click.echo("spot count differs: {} / {}".format(len(a), len(b)))
+            continue
+        for (xa, ya), (xb, yb) in zip(sorted(a), sorted(b)):
+            worst = max(worst, np.hypot(xa - xb, ya - yb))
+    click.echo("largest distance between the spots found: {:.2f} px".format(worst))
+    if video is None:
+        # against where the spot was drawn, in the frame (the roi is cut off)
+        x0, y0 = yuyv.roi[:2]
+        centers = np.array(_synthetic_centers(number)) - (x0, y0)
+        for name, found in (("find_laser_spots", [find_laser_spots(mjpg.process(j)) for j in jpegs]),
+                            ("find_laser_spots_yuyv", [find_laser_spots_yuyv(yuyv.process(r)) for r in raws])):
+            err = [np.hypot(*np.subtract(p[0], c)) for p, c in zip(found, centers) if len(p) == 1]
+            click.echo("{:<36} {:>7.2f} px mean, {:.2f} px max from the drawn center".format(
+                name, np.mean(err), np.max(err)))
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones')
+@click.option("--number", "-n", default=60, help='Frames')
+@click.option("--width", default=640, help='Frames are resized to this width')
+@click.option("--height", default=360, help='Frames are resized to this height')
+def spot(video: Optional[str], number: int, width: int, height: int):
+    """ms/frame of find_laser_spots against a LaserSpotDetector set up once (LAB chain, then LUT)"""
+    from video import LaserSpotDetector, extractByThresh, find_laser_spots, COLOR_MIN_RED, COLOR_MAX_RED
+    frames = [cv2.resize(f, (width, height), interpolation=cv2.INTER_AREA)
+              for f in _frames(video, number)]
+    detector = LaserSpotDetector(lut=False)
+    cases = [
+        ("extractByThresh", lambda f: extractByThresh(
+            f, COLOR_MIN_RED, COLOR_MAX_RED), frames),
+        ("LaserSpotDetector.threshold", detector.threshold, frames),
+        ("find_laser_spots", find_laser_spots, frames),
+        ("LaserSpotDetector.detect", detector.detect, frames),
+        ("LaserSpotDetector.detect, LUT", LaserSpotDetector(lut=True).detect, frames),
+    ]
+    for name, fn, inputs in cases:
+        click.echo("{:<36} {:>7.3f} ms/frame".format(
+            name, _ms_per_frame(fn, inputs)))
+    # the buffers must not change the result
+    for f in frames:
+        if not np.array_equal(extractByThresh(f, COLOR_MIN_RED, COLOR_MAX_RED), detector.threshold(f)) \
+                or find_laser_spots(f) != detector.detect(f):
+            raise click.ClickException("LaserSpotDetector differs from find_laser_spots")
+    click.echo("same masks and spots on all {} frames".format(len(frames)))
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones, e.g. test.avi')
+@click.option("--number", "-n", default=60, help='Frames')
+@click.option("--width", default=640, help='Frames are resized to this width')
+@click.option("--height", default=360, help='Frames are resized to this height')
+def mask(video: Optional[str], number: int, width: int, height: int):
+    """ms/frame and agreement of the LUT colour mask against extractByThresh"""
+    from video import LaserSpotDetector, build_color_lut, extractByLUT, extractByThresh, find_laser_spots, \
+        COLOR_MIN_RED, COLOR_MAX_RED
+    frames = [cv2.resize(f, (width, height), interpolation=cv2.INTER_AREA)
+              for f in _frames(video, number)]
+    lut = build_color_lut(COLOR_MIN_RED, COLOR_MAX_RED)
+    out = np.empty((height, width), dtype=np.uint8)
+    scratch = np.empty((height, width, 2), dtype=np.uint8)
+    cases = [
+        ("extractByThresh", lambda f: extractByThresh(
+            f, COLOR_MIN_RED, COLOR_MAX_RED), frames),
+        ("extractByLUT", lambda f: extractByLUT(f, lut, out, scratch), frames),
+    ]
+    for name, fn, inputs in cases:
+        click.echo("{:<36} {:>7.3f} ms/frame".format(
+            name, _ms_per_frame(fn, inputs)))
+    click.echo("{:<36} {:>7.3f} ms".format("build_color_lut", min(timeit.repeat(
+        lambda: build_color_lut(COLOR_MIN_RED, COLOR_MAX_RED), number=1, repeat=5)) * 1e3))
+
+    # extractByThresh ends with a blur, the blob detector starts at 50
+    differ = union = 0
+    for f in frames:
+        a = extractByThresh(f, COLOR_MIN_RED, COLOR_MAX_RED) >= 50
+        b = extractByLUT(f, lut) > 0
+        differ += np.count_nonzero(a != b)
+        union += np.count_nonzero(a | b)
+    click.echo("pixels differing: {} of {} ({} in either mask)".format(
+        differ, len(frames) * width * height, union))
+    detector = LaserSpotDetector(lut=True)
+    worst, mismatch = 0.0, 0
+    for f in frames:
+        a, b = find_laser_spots(f), detector.detect(f)
+        if len(a) != len(b):
+            mismatch += 1
+            continue
+        for (xa, ya), (xb, yb) in zip(sorted(a), sorted(b)):
+            worst = max(worst, np.hypot(xa - xb, ya - yb))
+    click.echo("frames with a different spot count: {}".format(mismatch))
+    click.echo("largest distance between the spots found: {:.2f} px".format(worst))
+    if video is None:
+        # against where the spot was drawn, in the resized frames
+        centers = np.array(_synthetic_centers(number)) * (width / 1280, height / 720)
+        for name, fn in (("find_laser_spots", find_laser_spots), ("LaserSpotDetector, LUT", detector.detect)):
+            found = [fn(f) for f in frames]
+            err = [np.hypot(*np.subtract(p[0], c)) for p, c in zip(found, centers) if len(p) == 1]
+            click.echo("{:<36} {:>7.2f} px mean, {:.2f} px max from the drawn center".format(
+                name, np.mean(err), np.max(err)))
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones')
+@click.option("--number", "-n", default=60, help='Frames')
+@click.option("--width", default=640, help='Frames are resized to this width')
+@click.option("--height", default=360, help='Frames are resized to this height')
+def classes(video: Optional[str], number: int, width: int, height: int):
+    """ms/frame of the red and green masks: one LAB chain or LUT per colour against one class LUT"""
+    from video import ColorClassifier, ColorSpotDetector, build_color_lut, extractByLUT, extractByThresh, \
+        COLOR_MIN_RED, COLOR_MAX_RED, COLOR_MIN_GREEN, COLOR_MAX_GREEN
+    frames = _frames(video, number)
+    if video is None:
+        # and a green spot chasing the red one
+        for f, (x, y) in zip(frames, _synthetic_centers(number + 5)[5:]):
+            cv2.circle(f, (x, y), 6, (0, 200, 100), -1)
+    frames = [cv2.resize(f, (width, height), interpolation=cv2.INTER_AREA)
+              for f in frames]
+    ranges = {"red": (COLOR_MIN_RED, COLOR_MAX_RED),
+              "green": (COLOR_MIN_GREEN, COLOR_MAX_GREEN)}
+    luts = [build_color_lut(*r) for r in ranges.values()]
+    classifier = ColorClassifier(ranges)
+
+    def per_colour(f: np.ndarray):
+        return [extractByThresh(f, *r) for r in ranges.values()]  # type: ignore
+
+    def per_lut(f: np.ndarray):
+        return [extractByLUT(f, lut) for lut in luts]
+    cases = [
+        ("extractByThresh x 2", per_colour, frames),
+        ("extractByLUT x 2", per_lut, frames),
+        ("ColorClassifier.extract", classifier.extract, frames),
+        ("ColorClassifier.classify", classifier.classify, frames),
+        ("ColorSpotDetector.detect", ColorSpotDetector().detect, frames),
+    ]
+    for name, fn, inputs in cases:
+        click.echo("{:<36} {:>7.3f} ms/frame".format(
+            name, _ms_per_frame(fn, inputs)))
+    click.echo("{:<36} {:>7.3f} ms".format("ColorClassifier.set_ranges", min(timeit.repeat(
+        lambda: classifier.set_ranges(ranges), number=1, repeat=5)) * 1e3))
+
+    # the classes don't overlap here, so the masks are those of each table
+    differ = 0
+    for f in frames:
+        masks = classifier.extract(f)
+        for name, lut in zip(ranges, luts):
+            differ += np.count_nonzero(masks[name] != extractByLUT(f, lut))
+    click.echo("pixels differing from extractByLUT: {}".format(differ))
+    spots = ColorSpotDetector().detect(frames[0])
+    click.echo("spots in the first frame: {}".format(", ".join(
+        "{} {}".format(k, [(round(x, 1), round(y, 1)) for x, y in v]) for k, v in spots.items())))
+
+
+@cli.command()
+@click.option("--number", "-n", default=60, help='Frames')
+@click.option("--width", default=640, help='Frame width')
+@click.option("--height", default=360, help='Frame height')
+@click.option("--radius", default=3.0, help='Radius of the spot in pixels')
+def moments(number: int, width: int, height: int, radius: float):
+    """ms/frame and error of SimpleBlobDetector against MomentSpotDetector, on spots drawn at sub-pixel positions"""
+    from math import pi
+    from video import LaserSpotDetector, MomentSpotDetector, create_blob_detector
+    rng = np.random.default_rng(1)
+    # the texture of the other benchmarks, at the same scale
+    background = cv2.resize(_synthetic_background(), (width, height), interpolation=cv2.INTER_AREA)
+    frames, truth = [], []
+    for _ in range(number):
+        x, y = rng.uniform(20, width - 20), rng.uniform(20, height - 20)
+        frame = background.copy()
+        # 4 fractional bits, anti-aliased
+        cv2.circle(frame, (int(round(x * 16)), int(round(y * 16))), int(round(radius * 16)),
+                   (150, 80, 255), -1, cv2.LINE_AA, 4)
+        frames.append(frame)
+        truth.append((x, y))
+
+    def report(name: str, detector_name: str, detect, inputs):
+        ms = _ms_per_frame(detect, inputs)
+        err = []
+        missed = 0
+        for i, t in zip(inputs, truth):
+            spots = [kp if isinstance(kp, tuple) else kp.pt for kp in detect(i)]
+            if len(spots) != 1:
+                missed += 1
+                continue
+            err.append(np.hypot(spots[0][0] - t[0], spots[0][1] - t[1]))
+        click.echo("{:<10} {:<22} {:>7.3f} ms/frame, error {:.2f} px mean {:.2f} px max, {} missed".format(
+            name, detector_name, ms, np.mean(err), np.max(err), missed))
+
+    blob = create_blob_detector(pi * 1 ** 2, pi * 10 ** 2)
+    moment = MomentSpotDetector(pi * 1 ** 2, pi * 10 ** 2)
+    for name, lut in (("LAB chain", False), ("LUT", True)):
+        threshold = LaserSpotDetector(lut=lut).threshold
+        masks = [threshold(f).copy() for f in frames]
+        for detector_name, detector in (("SimpleBlobDetector", blob), ("MomentSpotDetector", moment)):
+            report(name, detector_name, detector.detect, masks)
+        # the whole detector, the mask included, weighted by the red channel
+        report(name, "LaserSpotDetector(red)", LaserSpotDetector(lut=lut, moments=True).detect, frames)
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones')
+@click.option("--number", "-n", default=120, help='Frames')
+@click.option("--window", default=64, help='Side of the tracking window')
+def track(video: Optional[str], number: int, window: int):
+    """ms/frame of the whole-frame search against the tracking window, on the 570 x 550 crop of handle_frame"""
+    from collections import Counter
+    from video import LaserSpotDetector, LaserSpotTracker
+    if video is None:
+        frames = _synthetic_frames(number, (570, 550))
+        # the spot goes away for a few frames, to go through the fallback
+        for f in frames[number // 2:number // 2 + 3]:
+            f[:] = frames[0][0, 0]
+    else:
+        frames = [f[0:550, 170:740] for f in _frames(video, number)]
+    detector = LaserSpotDetector()
+    tracker = LaserSpotTracker(window)
+    click.echo("{:<36} {:>7.3f} ms/frame".format(
+        "LaserSpotDetector.detect", _ms_per_frame(detector.detect, frames)))
+    click.echo("{:<36} {:>7.3f} ms/frame".format(
+        "LaserSpotTracker.update", _ms_per_frame(tracker.update, frames)))
+
+    # steady state alone, and where both agree
+    tracker.reset()
+    paths: Counter = Counter()
+    worst = 0.0
+    tracked = []
+    for f in frames:
+        spot = tracker.update(f)
+        paths[spot.path] += 1
+        if spot.path == "track":
+            tracked.append(f)
+            spots = detector.detect(f)
+            if len(spots) == 1:
+                worst = max(worst, np.hypot(
+                    spot.pos[0] - spots[0][0], spot.pos[1] - spots[0][1]))  # type: ignore
+    tracker.update(tracked[0])
+    click.echo("{:<36} {:>7.3f} ms/frame".format(
+        "LaserSpotTracker.update, tracking", _ms_per_frame(tracker.update, tracked)))
+    click.echo("paths: {}".format(", ".join(
+        "{} {}".format(k, v) for k, v in sorted(paths.items()))))
+    click.echo("largest distance to the whole-frame search: {:.2f} px".format(worst))
+
+
+@cli.command()
+@click.option("--video", default=None, help='Take the frames from this file instead of synthetic ones')
+@click.option("--number", "-n", default=60, help='Frames')
+def decode(video: Optional[str], number: int):
+    """ms/frame of the JPEG decoder backends at 1/1, 1/2 and 1/4, against cv2.VideoCapture"""
+    import os
+    import tempfile
+    from camCfg import DECODERS
+    frames = _frames(video, number)
+    h, w = frames[0].shape[:2]
+    jpegs = [cv2.imencode(".jpg", f)[1].reshape(1, -1) for f in frames]
+
+    # what VideoCapture costs on an MJPG stream: demux and full decode
+    path = os.path.join(tempfile.mkdtemp(), "bench.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter.fourcc(
+        'M', 'J', 'P', 'G'), 30, (w, h))
+    for f in frames:
+        writer.write(f)
+    writer.release()
+
+    def read_all():
+        cap = cv2.VideoCapture(path)
+        buf = None
+        while True:
+            ok, buf = cap.read(buf)
+            if not ok:
+                break
+        cap.release()
+    best = min(timeit.repeat(read_all, number=1, repeat=5))
+    click.echo("{:<36} {:>7.3f} ms/frame".format(
+        "cv2.VideoCapture (1/1)", best / len(frames) * 1e3))
+    os.remove(path)
+
+    for name, cls in DECODERS.items():
+        try:
+            decoder = cls()
+        except ImportError as e:
+            click.echo("{:<36} not available ({})".format(name, e))
+            continue
+        for scale in (1, 2, 4):
+            out = [None]
+
+            def run(j: np.ndarray):
+                out[0] = decoder.decode(j, scale, out[0])
+            click.echo("{:<36} {:>7.3f} ms/frame".format(
+                "{} (1/{})".format(name, scale), _ms_per_frame(run, jpegs)))
+
+
+if __name__ == "__main__":
+    cli()
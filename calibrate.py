@@ -0,0 +1,106 @@
+import asyncio
+import click
+import numpy as np
+import serial_asyncio
+from loguru import logger
+from time import perf_counter
+from typing import List, Optional, Tuple
+import camCfg
+from motor.calibration import AngleLUT, fit_model
+from motor.motor import Motor, RotateTiltMotor, degree_to_pulse, speed_to_pulse_rate
+from motor.protocol import MotorProtocol
+from video import find_laser_spots
+
+
+def serpentine(rotate: np.ndarray, tilt: np.ndarray) -> List[Tuple[float, float]]:
+    # row by row, every other row backwards, so the gimbal never travels
+    # across the whole range between two points
+    grid = []
+    for i, t in enumerate(tilt):
+        for r in (rotate if i % 2 == 0 else rotate[::-1]):
+            grid.append((float(r), float(t)))
+    return grid
+
+
+def _frame_after(capture: camCfg.CaptureThread, t: float, timeout: float = 1.0) -> Optional[camCfg.Frame]:
+    seq = -1
+    deadline = perf_counter() + timeout
+    while True:
+        frame = capture.wait(seq, max(deadline - perf_counter(), 0))
+        if frame is None or frame.timestamp > t:
+            return frame
+        seq = frame.seq
+
+
+async def sweep(gimbal: RotateTiltMotor, capture: camCfg.CaptureThread, grid: List[Tuple[float, float]], speed: int, settle: float):
+    pixels, angles = [], []
+    shape = (0, 0)
+    for rotate, tilt in grid:
+        r0, t0 = gimbal.rotate_motor.last_position_deg, gimbal.tilt_motor.last_position_deg
+        gimbal.to_degree(speed, rotate, tilt)
+        pulse = max(abs(degree_to_pulse(rotate - r0, gimbal.rotate_motor.division)),  # type: ignore
+                    abs(degree_to_pulse(tilt - t0, gimbal.tilt_motor.division)))  # type: ignore
+        await asyncio.sleep(pulse / speed_to_pulse_rate(speed) + settle)
+        # a frame grabbed once the gimbal stood still
+        still = perf_counter()
+        frame = await asyncio.to_thread(_frame_after, capture, still)
+        if frame is None:
+            logger.warning("no frame at {:.2f}, {:.2f}".format(rotate, tilt))
+            continue
+        shape = frame.image.shape[:2]
+        spots = find_laser_spots(frame.image)
+        if len(spots) != 1:
+            logger.warning("{} spots at {:.2f}, {:.2f}".format(
+                len(spots), rotate, tilt))
+            continue
+        # the actual position rather than the commanded one
+        reading = await gimbal.get_degree()
+        logger.info("{} -> {:.3f}, {:.3f}".format(spots[0], *reading))
+        pixels.append(spots[0])
+        angles.append(reading)
+    return np.array(pixels), np.array(angles), shape
+
+
+@click.command()
+@click.option("--port", "-p", help='Serial port', required=True)
+@click.option("--baudrate", "-b", default=38400, help='Baudrate')
+@click.option("--rotate-range", default=15.0, help='Sweep +/- degrees around the current rotate position')
+@click.option("--tilt-range", default=10.0, help='Sweep +/- degrees around the current tilt position')
+@click.option("--steps", default=7, help='Grid points per axis')
+@click.option("--speed", default=40, help='Speed level of the moves')
+@click.option("--settle", default=0.3, help='Seconds to wait after a move')
+@click.option("--output", "-o", default="calibration.npy", help='Lookup table to write')
+def main(port: str, baudrate: int, rotate_range: float, tilt_range: float, steps: int, speed: int, settle: float, output: str):
+    """sweep the gimbal over a grid, fit the pixel to angle mapping and store it as a lookup table"""
+    async def run():
+        loop = asyncio.get_running_loop()
+        _, protocol = await serial_asyncio.create_serial_connection(
+            loop, MotorProtocol, port, baudrate=baudrate)
+        gimbal = RotateTiltMotor(Motor(0xe0, protocol), Motor(0xe1, protocol))  # type: ignore
+        gimbal.begin()
+        home = await gimbal.get_degree()
+        grid = serpentine(np.linspace(home[0] - rotate_range, home[0] + rotate_range, steps),
+                          np.linspace(home[1] - tilt_range, home[1] + tilt_range, steps))
+        camCfg.openCam()
+        capture = camCfg.startCapture()
+        try:
+            pixels, angles, shape = await sweep(gimbal, capture, grid, speed, settle)
+        finally:
+            camCfg.stopCapture()
+            camCfg.closeCam()
+            gimbal.to_degree(speed, *home)
+        logger.info("{} of {} points".format(len(pixels), len(grid)))
+        if len(pixels) < 8:
+            raise click.ClickException("not enough points to fit")
+        size = (shape[1], shape[0])
+        model, rms = fit_model(pixels, angles, size)
+        logger.info("rms error {:.3f} deg, k1 {:.4f} k2 {:.4f}".format(
+            rms, model.k1, model.k2))
+        AngleLUT.build(model, size).save(output)
+        logger.info("lookup table written to {}".format(output))
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import serial_asyncio
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from loguru import logger
+from .motor import Motor, RotateTiltMotor
+from .protocol import MotorProtocol
+from typing import Any, Dict, Iterator, List, Optional
+
+
+@dataclass
+class BusMetrics:
+    port: str
+    devices: List[int]
+    # reads waiting for their reply
+    inflight: int
+    # packets not on the wire yet, held back by an open batch or waiting for
+    # the inter frame gap
+    batched: int
+    bytes_written: int
+    bytes_read: int
+    # share of the line time used since the last reset, per direction
+    tx_utilisation: float
+    rx_utilisation: float
+
+
+class _Bus:
+    port: str
+    protocol: MotorProtocol
+    transport: Optional[asyncio.BaseTransport]
+    _since: float
+    _written: int
+    _read: int
+
+    def __init__(self, port: str, protocol: MotorProtocol, transport: Optional[asyncio.BaseTransport]) -> None:
+        self.port = port
+        self.protocol = protocol
+        self.transport = transport
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self._since = asyncio.get_event_loop().time()
+        self._written = self.protocol.bytes_written
+        self._read = self.protocol.bytes_read
+
+
+class BusManager:
+    """
+    Several serial ports, each with its own `MotorProtocol`, and the device
+    ids on them. Every bus has its own transport, in-flight table and batch,
+    so motors on different ports are commanded in parallel.
+    """
+    _buses: Dict[str, _Bus]
+    _ports: Dict[int, str]
+
+    def __init__(self) -> None:
+        self._buses = {}
+        self._ports = {}
+
+    async def open(self, port: str, baudrate: int = 38400, **protocol_kwargs: Any) -> MotorProtocol:
+        loop = asyncio.get_running_loop()
+        transport, protocol = await serial_asyncio.create_serial_connection(
+            loop, lambda: MotorProtocol(**protocol_kwargs), port, baudrate=baudrate)
+        self.add(port, protocol, transport)  # type: ignore
+        return protocol  # type: ignore
+
+    # a bus opened elsewhere (e.g. `motor.sim.create_sim_connection`). Its
+    # port closing no longer stops the loop, the other buses run on it
+    def add(self, port: str, protocol: MotorProtocol, transport: Optional[asyncio.BaseTransport] = None):
+        assert port not in self._buses, "{} already added".format(port)
+        protocol.stop_loop = False
+        self._buses[port] = _Bus(port, protocol, transport)
+
+    def protocol(self, port: str) -> MotorProtocol:
+        return self._buses[port].protocol
+
+    def protocol_for(self, id: int) -> MotorProtocol:
+        return self._buses[self._ports[id]].protocol
+
+    def motor(self, id: int, port: str, division: int = 16) -> Motor:
+        if port not in self._buses:
+            raise KeyError("no bus on {}".format(port))
+        if id in self._ports and self._ports[id] != port:
+            raise ValueError("device {:02x} is already on {}".format(
+                id, self._ports[id]))
+        self._ports[id] = port
+        logger.info("[{:02x}] on {}".format(id, port))
+        return Motor(id, self._buses[port].protocol, division)
+
+    def gimbal(self, rotate_id: int, rotate_port: str, tilt_id: int, tilt_port: str, division: int = 16) -> RotateTiltMotor:
+        return RotateTiltMotor(self.motor(rotate_id, rotate_port, division),
+                               self.motor(tilt_id, tilt_port, division))
+
+    # batch every bus at once; each one is flushed on its own port
+    @contextmanager
+    def batch(self) -> Iterator["BusManager"]:
+        with ExitStack() as stack:
+            for bus in self._buses.values():
+                stack.enter_context(bus.protocol.batch())
+            yield self
+
+    def flush(self):
+        for bus in self._buses.values():
+            bus.protocol.flush()
+
+    def reset_metrics(self):
+        for bus in self._buses.values():
+            bus.reset_metrics()
+
+    def metrics(self) -> List[BusMetrics]:
+        now = asyncio.get_event_loop().time()
+        ret = []
+        for bus in self._buses.values():
+            p = bus.protocol
+            written = p.bytes_written - bus._written
+            read = p.bytes_read - bus._read
+            elapsed = max(now - bus._since, 1e-9)
+            byte_time = p.byte_time()
+            ret.append(BusMetrics(
+                port=bus.port,
+                devices=[id for id, port in self._ports.items()
+                         if port == bus.port],
+                inflight=p.inflight_count(),
+                batched=p.batched_count(),
+                bytes_written=written,
+                bytes_read=read,
+                tx_utilisation=written * byte_time / elapsed,
+                rx_utilisation=read * byte_time / elapsed,
+            ))
+        return ret
+
+    def close(self):
+        for bus in self._buses.values():
+            if bus.transport is not None:
+                bus.transport.close()
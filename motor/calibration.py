@@ -0,0 +1,163 @@
+import json
+import numpy as np
+from .kinematics import GimbalModel
+from typing import Tuple
+
+
+def _normalise(points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Hartley normalisation: centroid at 0, mean distance sqrt(2)
+    mean = points.mean(axis=0)
+    d = np.sqrt(((points - mean) ** 2).sum(axis=1)).mean()
+    s = np.sqrt(2) / d if d > 0 else 1.0
+    t = np.array([[s, 0, -s * mean[0]], [0, s, -s * mean[1]], [0, 0, 1]])
+    return points * s - s * mean, t
+
+
+def fit_homography(src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """least squares (DLT) homography mapping `src` to `dst`, (N, 2) each"""
+    assert len(src) >= 4 and len(src) == len(dst)
+    s, ts = _normalise(np.asarray(src, dtype=np.float64))
+    d, td = _normalise(np.asarray(dst, dtype=np.float64))
+    n = len(s)
+    a = np.zeros((2 * n, 9))
+    a[0::2, 0:2] = s
+    a[0::2, 2] = 1
+    a[0::2, 6:8] = -d[:, :1] * s
+    a[0::2, 8] = -d[:, 0]
+    a[1::2, 3:5] = s
+    a[1::2, 5] = 1
+    a[1::2, 6:8] = -d[:, 1:] * s
+    a[1::2, 8] = -d[:, 1]
+    h = np.linalg.svd(a)[2][-1].reshape(3, 3)
+    h = np.linalg.inv(td) @ h @ ts
+    return h / h[2, 2]
+
+
+def _model(params: np.ndarray, center: Tuple[float, float], scale: float) -> GimbalModel:
+    h = np.append(params[:8], 1.0).reshape(3, 3)
+    return GimbalModel(h, 1.0, (0.0, 0.0), center, scale, params[8], params[9])
+
+
+def fit_model(pixels, angles, size: Tuple[int, int], iterations: int = 50) -> Tuple[GimbalModel, float]:
+    """
+    Fit a `GimbalModel` (homography plus radial distortion) to the laser spot
+    seen at `pixels` with the gimbal at `angles` (rotate, tilt in degrees),
+    both (N, 2). `size` is the image (width, height).
+
+    The plane is the one at unit distance in front of the gimbal at zero
+    angles: the camera sees the target through a homography and the target
+    is a central projection of that plane, so the composition is one
+    homography. The distortion is refined with Levenberg-Marquardt from the
+    DLT solution. Returns the model and the RMS error in degrees.
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    angles = np.asarray(angles, dtype=np.float64)
+    target = GimbalModel(distance=1.0).angles_to_plane(angles)
+    w, h = size
+    center = (w / 2, h / 2)
+    scale = float(np.hypot(w, h) / 2)
+
+    def residual(p: np.ndarray) -> np.ndarray:
+        return (_model(p, center, scale).pixel_to_plane(pixels) - target).ravel()
+
+    h0 = fit_homography(pixels, target)
+    params = np.append(h0.ravel()[:8], [0.0, 0.0])
+    r = residual(params)
+    cost = r @ r
+    damping = 1e-3
+    for _ in range(iterations):
+        # forward differences, each parameter stepped relative to its size
+        steps = 1e-7 * np.maximum(np.abs(params), 1e-3)
+        jac = np.empty((len(r), len(params)))
+        for i, step in enumerate(steps):
+            p = params.copy()
+            p[i] += step
+            jac[:, i] = (residual(p) - r) / step
+        jtj = jac.T @ jac
+        g = jac.T @ r
+        while True:
+            delta = np.linalg.solve(
+                jtj + damping * np.diag(np.diag(jtj)), -g)
+            candidate = params + delta
+            rc = residual(candidate)
+            if rc @ rc < cost:
+                params, r, cost = candidate, rc, rc @ rc
+                damping = max(damping / 10, 1e-12)
+                break
+            damping *= 10
+            if damping > 1e12:
+                break
+        if damping > 1e12 or np.abs(delta).max() < 1e-12:
+            break
+    model = _model(params, center, scale)
+    err = model.pixel_to_angles(pixels) - angles
+    return model, float(np.sqrt((err ** 2).sum(axis=1).mean()))
+
+
+class AngleLUT:
+    """
+    Gimbal angles for every pixel of the image, precomputed from a
+    `GimbalModel`. Saved as a plain `.npy` (and the model next to it as
+    `.json`) and memory mapped when loaded, so startup costs nothing and a
+    query is a single array index.
+    """
+    # (height, width, 2) of (rotate, tilt) degrees
+    table: np.ndarray
+    model: GimbalModel
+
+    def __init__(self, table: np.ndarray, model: GimbalModel) -> None:
+        assert table.ndim == 3 and table.shape[2] == 2
+        self.table = table
+        self.model = model
+
+    @classmethod
+    def build(cls, model: GimbalModel, size: Tuple[int, int]) -> "AngleLUT":
+        w, h = size
+        ys, xs = np.mgrid[0:h, 0:w]
+        pixels = np.stack((xs, ys), axis=-1)
+        return cls(model.pixel_to_angles(pixels).astype(np.float32), model)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.table.shape[1], self.table.shape[0]
+
+    def lookup(self, x: float, y: float) -> Tuple[float, float]:
+        """(rotate, tilt) of the nearest pixel, clamped to the image"""
+        h, w = self.table.shape[:2]
+        # halves round up; `int` only truncates differently below 0, where
+        # both end up clamped to 0
+        xi = min(max(int(x + 0.5), 0), w - 1)
+        yi = min(max(int(y + 0.5), 0), h - 1)
+        return self.table.item(yi, xi, 0), self.table.item(yi, xi, 1)
+
+    def lookup_many(self, points) -> np.ndarray:
+        """`lookup` of an array of (x, y), the same cells: halves round up"""
+        p = np.floor(np.asarray(points, dtype=np.float64) + 0.5).astype(np.intp)
+        h, w = self.table.shape[:2]
+        xi = np.clip(p[..., 0], 0, w - 1)
+        yi = np.clip(p[..., 1], 0, h - 1)
+        return self.table[yi, xi]
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.save(f, np.ascontiguousarray(self.table))
+        m = self.model
+        with open(path + ".json", "w") as f:
+            json.dump({
+                "homography": m.homography.tolist(),
+                "distance": m.distance,
+                "origin": list(m.origin),
+                "center": list(m.center),
+                "scale": m.scale,
+                "k1": m.k1,
+                "k2": m.k2,
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "AngleLUT":
+        with open(path + ".json") as f:
+            params = json.load(f)
+        model = GimbalModel(np.array(params["homography"]), params["distance"],
+                            tuple(params["origin"]), tuple(params["center"]),
+                            params["scale"], params["k1"], params["k2"])
+        return cls(np.load(path, mmap_mode="r"), model)
@@ -0,0 +1,150 @@
+"""
+Binary capture of the serial traffic, kept in a memory mapped ring file.
+
+    header  <magic:4s> <version:B> <capacity:I> <head:I> <tail:I> <empty:B>
+    record  <time_ns:Q> <direction:B> <length:H> <data>
+
+`time_ns` is `perf_counter_ns()`. `direction` is TX or RX with the bytes on
+the wire, or EXPIRE with `<id> <cmd>` of a read that timed out (the replay
+drops the request at the same point as the live run did). Records are appended at `head`; once the
+ring is full the oldest ones (from `tail`) are dropped. A record never wraps:
+if it doesn't fit before the end of the ring, a PAD record (or, when there's
+no room for it, nothing) marks the rest as unused and it starts over at 0.
+"""
+import mmap
+import struct
+from time import perf_counter_ns
+from typing import Iterator, NamedTuple
+
+MAGIC = b"MCAP"
+VERSION = 1
+TX = 0
+RX = 1
+EXPIRE = 2
+PAD = 0xff
+
+_HEADER = struct.Struct("<4sBIIIB")
+_RECORD = struct.Struct("<QBH")
+
+
+class Record(NamedTuple):
+    time_ns: int
+    direction: int
+    data: bytes
+
+
+class CaptureWriter:
+    """
+    Append the frames to the ring. A write is two `pack_into` and a slice
+    assignment into the mapping, no system call, so it can stay on in the
+    hot path.
+    """
+    path: str
+    capacity: int
+    _file: object
+    _mm: mmap.mmap
+    _head: int
+    _tail: int
+    _empty: bool
+
+    def __init__(self, path: str, capacity: int = 1 << 20) -> None:
+        assert capacity > _RECORD.size
+        self.path = path
+        self.capacity = capacity
+        size = _HEADER.size + capacity
+        self._file = open(path, "w+b")
+        self._file.truncate(size)  # type: ignore
+        self._mm = mmap.mmap(self._file.fileno(), size)  # type: ignore
+        self._head = 0
+        self._tail = 0
+        self._empty = True
+        self._sync_header()
+
+    def _sync_header(self):
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.capacity,
+                          self._head, self._tail, int(self._empty))
+
+    def _advance_tail(self):
+        off = _HEADER.size + self._tail
+        if self.capacity - self._tail < _RECORD.size:
+            self._tail = 0
+        else:
+            _, direction, length = _RECORD.unpack_from(self._mm, off)
+            if direction == PAD:
+                self._tail = 0
+            else:
+                self._tail += _RECORD.size + length
+                if self._tail == self.capacity:
+                    self._tail = 0
+        if self._tail == self._head:
+            self._empty = True
+
+    def write(self, direction: int, data: bytes, time_ns: int = 0):
+        n = _RECORD.size + len(data)
+        assert n <= self.capacity
+        if self.capacity - self._head < n:
+            # the rest of the ring is skipped, so are the records in there
+            if self.capacity - self._head >= _RECORD.size:
+                _RECORD.pack_into(self._mm, _HEADER.size +
+                                  self._head, 0, PAD, 0)
+            if not self._empty and self._tail >= self._head:
+                self._tail = 0
+            self._head = 0
+        if self._empty:
+            self._tail = self._head
+        else:
+            while not self._empty and self._head <= self._tail < self._head + n:
+                self._advance_tail()
+            if self._empty:
+                self._tail = self._head
+        off = _HEADER.size + self._head
+        _RECORD.pack_into(self._mm, off, time_ns or perf_counter_ns(),
+                          direction, len(data))
+        self._mm[off + _RECORD.size:off + n] = data
+        self._head += n
+        if self._head == self.capacity:
+            self._head = 0
+        self._empty = False
+        self._sync_header()
+
+    def flush(self):
+        self._mm.flush()
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()  # type: ignore
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_capture(path: str) -> Iterator[Record]:
+    """the records of a capture, oldest first"""
+    with open(path, "rb") as f:
+        buf = f.read()
+    magic, version, capacity, head, tail, empty = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a capture".format(path))
+    if empty:
+        return
+    data = memoryview(buf)[_HEADER.size:_HEADER.size + capacity]
+    pos = tail
+    while True:
+        if capacity - pos < _RECORD.size:
+            pos = 0
+        else:
+            time_ns, direction, length = _RECORD.unpack_from(data, pos)
+            if direction == PAD:
+                pos = 0
+            else:
+                start = pos + _RECORD.size
+                yield Record(time_ns, direction, bytes(data[start:start + length]))
+                pos = start + length
+                if pos == capacity:
+                    pos = 0
+        if pos == head:
+            return
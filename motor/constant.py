@@ -47,3 +47,42 @@ CTRL_STOP = 0xf7
 # @ret <device_id> <flag>[0x02, 0x9f] <end_byte>
 #  0x02 means start running, 0x9f means running finished
 CTRL_SPEED_WITH_PULSE_CNT = 0xfd
+
+## REQUEST
+
+# size of each request (including <device_id> and <flag>)
+# flags starting with 0xff are 2 bytes wide (see `FlagWidth.SHORT`)
+REQUEST_SIZE = {
+    READ_ENCODER: 2,
+    READ_INPUT_PULSE_COUNT: 2,
+    READ_POSITION: 2,
+    READ_POSITION_ERROR: 2,
+    READ_EN_CLOSE_LOOP: 2,
+    READ_STUCK_FLAG: 2,
+    SET_DIVISION: 3,
+    CTRL_EN_CLOSE_LOOP: 3,
+    CTRL_SPEED: 3,
+    CTRL_STOP: 2,
+    CTRL_SPEED_WITH_PULSE_CNT: 5,
+}
+SHORT_FLAG_PREFIX = 0xff
+SHORT_FLAG_REQUEST_SIZE = 3
+
+## REPLY
+
+# size of the reply (including the leading <device_id>) for each read command
+# the controller answers in the order the requests were sent
+REPLY_SIZE = {
+    READ_ENCODER: 3,
+    READ_INPUT_PULSE_COUNT: 5,
+    READ_POSITION: 5,
+    READ_POSITION_ERROR: 3,
+    READ_EN_CLOSE_LOOP: 2,
+    READ_STUCK_FLAG: 2,
+}
+# @ret <device_id> <status>
+# the size of a frame nobody asked for, e.g. the reply of a CTRL/SET command
+STATUS_REPLY_SIZE = 2
+# the statuses of `CTRL_SPEED_WITH_PULSE_CNT`
+STATUS_START = 0x02
+STATUS_FINISH = 0x9f
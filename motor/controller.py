@@ -0,0 +1,157 @@
+import numpy as np
+from dataclasses import dataclass
+from .constant import SPEED_MAX
+from .motor import RotateTiltMotor
+from typing import Optional, Union
+
+ArrayLike = Union[float, np.ndarray]
+
+
+## gain schedule, see `mapping.ipynb`
+
+@dataclass
+class ExtremumParams:
+    x_min: float
+    x_max: float
+    y_min: float
+    y_max: float
+
+
+@dataclass
+class PiecewiseLinearParams:
+    alpha: float
+    alpha_slope: float
+    beta_slope: float
+    gamma_slope: float
+
+
+def piecewise_linear_mapper(x: ArrayLike, extremum: ExtremumParams, piecewise: PiecewiseLinearParams) -> np.ndarray:
+    """
+    `piecewise_linear_mapper` of `mapping.ipynb` on arrays. Maps |x| to
+    [y_min, y_max] with three slopes: alpha up to `alpha`, then gamma until
+    it meets the beta line that ends in (x_max, y_max).
+    """
+    x_min, x_max = extremum.x_min, extremum.x_max
+    y_min, y_max = extremum.y_min, extremum.y_max
+    scaled_alpha = (min(max(piecewise.alpha, x_min), x_max) -
+                    x_min) / (x_max - x_min)
+    scaled_x = (np.clip(np.abs(x), x_min, x_max) - x_min) / (x_max - x_min)
+
+    alpha_y = scaled_alpha * piecewise.alpha_slope
+    k_1, k_2 = piecewise.beta_slope, piecewise.gamma_slope
+    # where the gamma and beta lines intersect
+    beta_x = (alpha_y - 1 + k_1 * 1 - k_2 * scaled_alpha) / (k_1 - k_2)
+    gamma_y = (scaled_x - scaled_alpha) * k_2 + alpha_y
+    beta_y = (scaled_x - 1) * k_1 + 1
+    mapped_y = np.where(scaled_x < scaled_alpha, scaled_x * piecewise.alpha_slope,
+                        np.where(scaled_x < beta_x, gamma_y, beta_y))
+    return y_min + mapped_y * (y_max - y_min)
+
+
+class VelocityController:
+    """
+    PID with feed-forward in velocity mode, one lane per axis (all the
+    parameters broadcast against the error, e.g. `[rotate, tilt]`).
+
+    The input is the error seen by the camera (px), the output is a signed
+    speed level for `ctrl_speed`. With `schedule` the proportional term is
+    `piecewise_linear_mapper(|error|) * sign(error)` instead of `kp * error`.
+    The integral stops growing while the output is saturated in the same
+    direction (anti-windup) and the derivative goes through a first order
+    low pass of time constant `d_tau` seconds.
+    """
+    kp: np.ndarray
+    ki: np.ndarray
+    kd: np.ndarray
+    kff: np.ndarray
+    d_tau: float
+    output_limit: float
+    # |output| below that is sent as a stop
+    deadband: float
+    schedule: Optional[tuple]
+    _integral: np.ndarray
+    _prev_error: Optional[np.ndarray]
+    _derivative: np.ndarray
+
+    def __init__(self, kp: ArrayLike, ki: ArrayLike = 0.0, kd: ArrayLike = 0.0, kff: ArrayLike = 0.0, d_tau: float = 0.02, output_limit: float = SPEED_MAX, deadband: float = 1.0, schedule: Optional[tuple] = None, axes: int = 2) -> None:
+        shape = (axes,)
+        self.kp = np.broadcast_to(np.asarray(kp, dtype=np.float64), shape)
+        self.ki = np.broadcast_to(np.asarray(ki, dtype=np.float64), shape)
+        self.kd = np.broadcast_to(np.asarray(kd, dtype=np.float64), shape)
+        self.kff = np.broadcast_to(np.asarray(kff, dtype=np.float64), shape)
+        self.d_tau = d_tau
+        self.output_limit = output_limit
+        self.deadband = deadband
+        # (ExtremumParams, PiecewiseLinearParams)
+        self.schedule = schedule
+        self._integral = np.zeros(shape)
+        self._derivative = np.zeros(shape)
+        self._prev_error = None
+
+    def reset(self):
+        self._integral[:] = 0
+        self._derivative[:] = 0
+        self._prev_error = None
+
+    def update(self, error: ArrayLike, dt: float, feed_forward: ArrayLike = 0.0) -> np.ndarray:
+        """
+        `feed_forward` is the velocity of the target (e.g. px/s), scaled by
+        `kff`. Returns the signed speed of each axis.
+        """
+        e = np.asarray(error, dtype=np.float64)
+        if self.schedule is not None:
+            p = np.sign(e) * piecewise_linear_mapper(e, *self.schedule)
+        else:
+            p = self.kp * e
+
+        if self._prev_error is not None and dt > 0:
+            raw = (e - self._prev_error) / dt
+            a = dt / (self.d_tau + dt)
+            self._derivative += a * (raw - self._derivative)
+        # the caller may reuse its array
+        self._prev_error = e.copy()
+
+        limit = self.output_limit
+        integral = self._integral + self.ki * e * dt
+        u = p + integral + self.kd * self._derivative + self.kff * \
+            np.asarray(feed_forward, dtype=np.float64)
+        # keep integrating only where it doesn't push further into saturation
+        winding = ((u > limit) & (e > 0)) | ((u < -limit) & (e < 0))
+        self._integral = np.where(winding, self._integral, integral)
+        self._integral = np.clip(self._integral, -limit, limit)
+
+        u = np.clip(u, -limit, limit)
+        return np.where(np.abs(u) < self.deadband, 0.0, u)
+
+
+class GimbalVelocityDriver:
+    """
+    Drive a `RotateTiltMotor` from a `VelocityController`. A command is only
+    sent to an axis whose speed level changed, so a steady tracking costs no
+    bus traffic at all.
+    """
+    gimbal: RotateTiltMotor
+    controller: VelocityController
+    _last: Optional[np.ndarray]
+
+    def __init__(self, gimbal: RotateTiltMotor, controller: VelocityController) -> None:
+        self.gimbal = gimbal
+        self.controller = controller
+        self._last = None
+
+    # returns the number of packets sent
+    def update(self, error: ArrayLike, dt: float, feed_forward: ArrayLike = 0.0) -> int:
+        speed = np.trunc(self.controller.update(error, dt, feed_forward))
+        changed = np.ones(speed.shape, dtype=bool) if self._last is None else speed != self._last
+        self._last = speed
+        motors = (self.gimbal.rotate_motor, self.gimbal.tilt_motor)
+        with motors[0].protocol.batch(), motors[1].protocol.batch():
+            for motor, s, c in zip(motors, speed, changed):
+                if c:
+                    motor.run_speed(s)
+        return int(changed.sum())
+
+    def stop(self):
+        self.controller.reset()
+        self._last = None
+        self.gimbal.run_speed(0, 0)
@@ -0,0 +1,159 @@
+from collections import deque
+from loguru import logger
+from .constant import REPLY_SIZE, REQUEST_SIZE, SHORT_FLAG_PREFIX, SHORT_FLAG_REQUEST_SIZE, STATUS_REPLY_SIZE, \
+    STATUS_START, STATUS_FINISH
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+# (device_id, command or None for a status frame, raw frame including the id)
+Frame = Tuple[int, Optional[int], bytes]
+
+# in the pending FIFO of a device: the start status of a move
+_START = -1
+
+
+class FrameParser:
+    """
+    Reassemble the byte stream coming from the UART into whole reply frames.
+
+    The replies carry no command byte nor length, so the parser has to be told
+    which command each device is expected to answer (see `expect`). The
+    controllers answer in request order, hence a FIFO per device id. A frame
+    from a device with nothing pending is taken as a status frame
+    (`<device_id> <status>`), e.g. the reply of a CTRL command.
+
+    A `CTRL_SPEED_WITH_PULSE_CNT` is answered twice (see `expect_status`):
+    the start frame in request order, and the finish frame whenever the move
+    is done, possibly in front of a read reply. A finish frame is told from
+    a read reply starting with the same byte by where the next frame would
+    begin.
+
+    A read (or a coalesced run of reads) may contain any number of frames
+    and may end in the middle of one; the tail is kept until the next read.
+    """
+    _buf: bytearray
+    _pending: Dict[int, Deque[int]]
+    # finish frames still to come, per device
+    _finishing: Dict[int, int]
+    _ids: Set[int]
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+        self._pending = {}
+        self._finishing = {}
+        self._ids = set()
+
+    def register(self, id: int):
+        self._ids.add(id)
+        self._pending.setdefault(id, deque())
+        self._finishing.setdefault(id, 0)
+
+    def expect(self, id: int, cmd: int):
+        assert cmd in REPLY_SIZE
+        self._pending[id].append(cmd)
+
+    # a `CTRL_SPEED_WITH_PULSE_CNT` was sent to `id`
+    def expect_status(self, id: int):
+        self._pending[id].append(_START)
+        self._finishing[id] += 1
+
+    def discard(self, id: int, cmd: int):
+        # called when a request is abandoned (e.g. timeout) so that a lost
+        # reply won't shift the framing of the following ones
+        pending = self._pending.get(id)
+        if pending is not None and cmd in pending:
+            pending.remove(cmd)
+
+    def clear(self):
+        self._buf.clear()
+        for pending in self._pending.values():
+            pending.clear()
+        for id in self._finishing:
+            self._finishing[id] = 0
+
+    def _is_finish(self, pos: int) -> Optional[bool]:
+        # `<id> 0x9f` at `pos` while a read of that device is pending. A finish
+        # frame is followed by another frame, while the byte after the first
+        # two of a read reply is part of its value and rarely a device id.
+        # None when that byte isn't there yet
+        pos += STATUS_REPLY_SIZE
+        if pos >= len(self._buf):
+            return None
+        return self._buf[pos] in self._ids
+
+    def feed(self, data: bytes) -> List[Frame]:
+        buf = self._buf
+        buf += data
+        frames: List[Frame] = []
+        pos = 0
+        dropped = 0
+        n = len(buf)
+        with memoryview(buf) as view:
+            while pos < n:
+                id = buf[pos]
+                if id not in self._ids:
+                    # out of sync or noise on the line. skip until a known id
+                    pos += 1
+                    dropped += 1
+                    continue
+                if n - pos < STATUS_REPLY_SIZE:
+                    break
+                pending = self._pending[id]
+                status = buf[pos + 1]
+                if pending and pending[0] == _START and status == STATUS_START:
+                    pending.popleft()
+                    frames.append((id, None, bytes(view[pos:pos + STATUS_REPLY_SIZE])))
+                    pos += STATUS_REPLY_SIZE
+                    continue
+                # only a move that has started can finish
+                if status == STATUS_FINISH and self._finishing[id] > pending.count(_START):
+                    finish = self._is_finish(pos) if pending and pending[0] != _START else True
+                    if finish is None:
+                        break
+                    if finish:
+                        self._finishing[id] -= 1
+                        frames.append((id, None, bytes(view[pos:pos + STATUS_REPLY_SIZE])))
+                        pos += STATUS_REPLY_SIZE
+                        continue
+                # the start frame of a move that never made it
+                while pending and pending[0] == _START:
+                    pending.popleft()
+                    self._finishing[id] -= 1
+                cmd = pending[0] if pending else None
+                size = REPLY_SIZE[cmd] if cmd is not None else STATUS_REPLY_SIZE
+                if n - pos < size:
+                    break
+                if cmd is not None:
+                    pending.popleft()
+                frames.append((id, cmd, bytes(view[pos:pos + size])))
+                pos += size
+        if pos:
+            del buf[:pos]
+        if dropped:
+            logger.warning("dropped {} unexpected bytes".format(dropped))
+        return frames
+
+
+def split_requests(buf: bytes) -> Tuple[List[bytes], int]:
+    """
+    Split the bytes sent to the controllers into requests. Returns the
+    requests and how many bytes were consumed; an incomplete request at the
+    end is left for later and unknown commands are skipped.
+    """
+    frames: List[bytes] = []
+    pos = 0
+    n = len(buf)
+    while n - pos >= 2:
+        cmd = buf[pos + 1]
+        if cmd == SHORT_FLAG_PREFIX:
+            size = SHORT_FLAG_REQUEST_SIZE
+        elif cmd in REQUEST_SIZE:
+            size = REQUEST_SIZE[cmd]
+        else:
+            logger.warning("unknown command {:02x}".format(cmd))
+            pos += 1
+            continue
+        if n - pos < size:
+            break
+        frames.append(bytes(buf[pos:pos + size]))
+        pos += size
+    return frames, pos
@@ -0,0 +1,122 @@
+import numpy as np
+from dataclasses import dataclass, field
+from typing import Tuple
+
+
+def degrees_to_pulses(degree: np.ndarray, division: int, step_angle: float = 1.8) -> np.ndarray:
+    """`degree_to_pulse` on arrays, same rounding (half to even)"""
+    return np.rint(np.asarray(degree, dtype=np.float64) * (division / step_angle)).astype(np.int64)
+
+
+def pulses_to_degrees(pulse: np.ndarray, division: int, step_angle: float = 1.8) -> np.ndarray:
+    return np.asarray(pulse, dtype=np.float64) * (step_angle / division)
+
+
+def _as_points(points) -> np.ndarray:
+    pts = np.asarray(points, dtype=np.float64)
+    assert pts.shape[-1] == 2, "points must be (..., 2)"
+    return pts
+
+
+@dataclass
+class GimbalModel:
+    """
+    Camera to gimbal model, from image points to the angles pointing the laser
+    at them. Every method takes arrays of points of shape `(..., 2)` (x, y)
+    and works on all of them at once.
+
+    pixel -> undistorted pixel: radial, `p_u = c + (p - c) * (1 + k1 r^2 + k2 r^4)`
+        with `r = |p - c| / scale`, `c` the `center`
+    undistorted pixel -> plane: `homography`, to the target plane (mm)
+    plane -> angles: the rotate axis is vertical and carries the tilt axis,
+        both cross at `distance` mm in front of the plane and point at
+        `origin` (mm) at zero angles. Positive angles go to +x / +y of the
+        plane, the homography takes care of the image orientation.
+    """
+    homography: np.ndarray = field(default_factory=lambda: np.eye(3))
+    # mm between the gimbal axes and the target plane
+    distance: float = 1000.0
+    # point of the plane at zero angles (mm)
+    origin: Tuple[float, float] = (0.0, 0.0)
+    # distortion center (px) and radius normalisation
+    center: Tuple[float, float] = (0.0, 0.0)
+    scale: float = 1.0
+    k1: float = 0.0
+    k2: float = 0.0
+
+    def __post_init__(self):
+        self.homography = np.asarray(self.homography, dtype=np.float64)
+        assert self.homography.shape == (3, 3)
+
+    def undistort(self, pixels) -> np.ndarray:
+        p = _as_points(pixels)
+        if self.k1 == 0 and self.k2 == 0:
+            return p
+        c = np.asarray(self.center)
+        d = p - c
+        r2 = np.einsum("...i,...i->...", d, d) / (self.scale * self.scale)
+        return c + d * (1 + self.k1 * r2 + self.k2 * r2 * r2)[..., None]
+
+    def distort(self, pixels, iterations: int = 8) -> np.ndarray:
+        # no closed form; fixed point iterations, plenty for the small
+        # distortion of a webcam
+        u = _as_points(pixels)
+        if self.k1 == 0 and self.k2 == 0:
+            return u
+        c = np.asarray(self.center)
+        du = u - c
+        d = du
+        for _ in range(iterations):
+            r2 = np.einsum("...i,...i->...", d, d) / (self.scale * self.scale)
+            d = du / (1 + self.k1 * r2 + self.k2 * r2 * r2)[..., None]
+        return c + d
+
+    def pixel_to_plane(self, pixels) -> np.ndarray:
+        return _apply_homography(self.homography, self.undistort(pixels))
+
+    def plane_to_pixel(self, plane) -> np.ndarray:
+        return self.distort(_apply_homography(np.linalg.inv(self.homography), _as_points(plane)))
+
+    def plane_to_angles(self, plane) -> np.ndarray:
+        """(..., 2) of (rotate, tilt) degrees"""
+        p = _as_points(plane) - np.asarray(self.origin)
+        x, y = p[..., 0], p[..., 1]
+        rotate = np.arctan2(x, self.distance)
+        tilt = np.arctan2(y, np.hypot(x, self.distance))
+        return np.degrees(np.stack((rotate, tilt), axis=-1))
+
+    def angles_to_plane(self, angles) -> np.ndarray:
+        a = np.radians(_as_points(angles))
+        x = self.distance * np.tan(a[..., 0])
+        y = np.hypot(x, self.distance) * np.tan(a[..., 1])
+        return np.stack((x, y), axis=-1) + np.asarray(self.origin)
+
+    def pixel_to_angles(self, pixels) -> np.ndarray:
+        return self.plane_to_angles(self.pixel_to_plane(pixels))
+
+    def angles_to_pixel(self, angles) -> np.ndarray:
+        return self.plane_to_pixel(self.angles_to_plane(angles))
+
+    def pixel_to_pulses(self, pixels, division: int, step_angle: float = 1.8) -> np.ndarray:
+        """absolute pulses from zero angles, (..., 2) of (rotate, tilt)"""
+        return degrees_to_pulses(self.pixel_to_angles(pixels), division, step_angle)
+
+    def error_to_angles(self, spot, target) -> np.ndarray:
+        """the (rotate, tilt) move bringing the laser from `spot` to `target`"""
+        return self.pixel_to_angles(target) - self.pixel_to_angles(spot)
+
+    def plan_path(self, pixels, angular_speed: float, t0: float = 0.0) -> np.ndarray:
+        """
+        Timed waypoints `(t, rotate_deg, tilt_deg)` along a path of image
+        points, at `angular_speed` deg/s along the larger of the two axes.
+        The rows can be given to `TrajectoryQueue.extend` as is.
+        """
+        angles = self.pixel_to_angles(pixels).reshape(-1, 2)
+        step = np.abs(np.diff(angles, axis=0)).max(axis=1)
+        t = t0 + np.concatenate(([0.0], np.cumsum(step) / angular_speed))
+        return np.column_stack((t, angles))
+
+
+def _apply_homography(h: np.ndarray, points: np.ndarray) -> np.ndarray:
+    p = points @ h[:, :2].T + h[:, 2]
+    return p[..., :2] / p[..., 2:3]
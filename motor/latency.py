@@ -0,0 +1,242 @@
+import math
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+
+class DeviceUnavailable(IOError):
+    """raised without touching the bus while a device's circuit is open"""
+    pass
+
+
+class LatencyHistogram:
+    """
+    Round trip times in log spaced buckets: bucket `i` covers
+    `[low * ratio ** (i - 1), low * ratio ** i)`, the first and the last one
+    take whatever falls outside `[low, high)`. A quantile is the upper bound
+    of its bucket, i.e. at most `ratio - 1` too high, which is the safe side
+    for a timeout.
+
+    Once `window` samples are in, every bucket is halved so that the old
+    samples fade out.
+    """
+    low: float
+    high: float
+    ratio: float
+    alpha: float
+    window: int
+    # exponentially weighted moving average, nan before the first sample
+    ewma: float
+    max: float
+    count: int
+    _log_ratio: float
+    _buckets: List[int]
+
+    def __init__(self, low: float = 1e-4, high: float = 2.0, ratio: float = 1.1, alpha: float = 0.1, window: int = 1024) -> None:
+        assert 0 < low < high and ratio > 1
+        self.low = low
+        self.high = high
+        self.ratio = ratio
+        self.alpha = alpha
+        self.window = window
+        self._log_ratio = math.log(ratio)
+        n = math.ceil(math.log(high / low) / self._log_ratio)
+        self._buckets = [0] * (n + 2)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self._buckets)):
+            self._buckets[i] = 0
+        self.count = 0
+        self.ewma = float("nan")
+        self.max = 0.0
+
+    def _index(self, x: float) -> int:
+        if x < self.low:
+            return 0
+        return min(int(math.log(x / self.low) / self._log_ratio) + 1, len(self._buckets) - 1)
+
+    def _upper(self, i: int) -> float:
+        if i == len(self._buckets) - 1:
+            return self.max
+        return self.low * self.ratio ** i
+
+    def record(self, x: float):
+        self._buckets[self._index(x)] += 1
+        self.count += 1
+        self.ewma = x if math.isnan(self.ewma) else \
+            self.ewma + self.alpha * (x - self.ewma)
+        self.max = max(self.max, x)
+        if self.count >= self.window:
+            self.count = 0
+            for i, c in enumerate(self._buckets):
+                self._buckets[i] = c // 2
+                self.count += c // 2
+
+    def quantile(self, q: float) -> float:
+        assert 0 <= q <= 1
+        if self.count == 0:
+            return float("nan")
+        rank = q * self.count
+        acc = 0
+        for i, c in enumerate(self._buckets):
+            acc += c
+            if acc >= rank and c > 0:
+                return min(self._upper(i), self.max)
+        return self.max
+
+    # (upper bound, count) of the non empty buckets
+    def buckets(self) -> List[Tuple[float, int]]:
+        return [(self._upper(i), c) for i, c in enumerate(self._buckets) if c > 0]
+
+    def __str__(self) -> str:
+        if self.count == 0:
+            return "n:0"
+        return "n:{} ewma:{:.2f}ms p50:{:.2f}ms p99:{:.2f}ms max:{:.2f}ms".format(
+            self.count, self.ewma * 1e3, self.quantile(0.5) * 1e3, self.quantile(0.99) * 1e3, self.max * 1e3)
+
+
+@dataclass
+class DeviceStats:
+    latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+    replies: int = 0
+    timeouts: int = 0
+    # timeouts since the last reply
+    failures: int = 0
+    # `perf_counter()` until which the circuit is open
+    open_until: float = 0.0
+    cooldown: float = 0.0
+    # the single try through the half open circuit is in flight
+    probe: bool = False
+    # timeout of the first try, recomputed every `RetryPolicy.refresh` replies
+    timeout: float = 0.0
+    stale: int = 0
+
+
+class RetryPolicy:
+    """
+    Per device read timeouts taken from the observed round trip times, and a
+    circuit breaker for devices that stopped answering.
+
+    The timeout is `margin` times the `quantile` of the latency, within
+    `[min_timeout, max_timeout]`. Until a device has given `min_samples`
+    replies the latency of the whole bus is used instead, and
+    `initial_timeout` until the bus has. Retry `i` waits
+    `backoff * backoff_factor ** (i - 1)` first and gets a timeout
+    `timeout_factor ** i` times longer.
+
+    After `failure_threshold` timeouts in a row the circuit opens: the reads
+    fail at once with `DeviceUnavailable` for `cooldown` seconds. Then a
+    single try is let through (the other reads keep failing until it is
+    answered or times out); if it times out too, the circuit opens again
+    for twice as long (up to `max_cooldown`).
+    """
+    initial_timeout: float
+    min_timeout: float
+    max_timeout: float
+    quantile: float
+    margin: float
+    min_samples: int
+    backoff: float
+    backoff_factor: float
+    timeout_factor: float
+    failure_threshold: int
+    cooldown: float
+    max_cooldown: float
+    refresh: int
+    _devices: Dict[int, DeviceStats]
+    # every reply, whatever the device
+    _bus: LatencyHistogram
+
+    def __init__(self, initial_timeout: float = 0.1, min_timeout: float = 0.005, max_timeout: float = 0.5,
+                 quantile: float = 0.99, margin: float = 1.5, min_samples: int = 20,
+                 backoff: float = 0.002, backoff_factor: float = 2.0, timeout_factor: float = 1.5,
+                 failure_threshold: int = 3, cooldown: float = 0.5, max_cooldown: float = 8.0,
+                 refresh: int = 16) -> None:
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.timeout_factor = timeout_factor
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.refresh = refresh
+        self._devices = {}
+        self._bus = LatencyHistogram()
+
+    def stats(self, id: int) -> DeviceStats:
+        stats = self._devices.get(id)
+        if stats is None:
+            stats = self._devices[id] = DeviceStats()
+        return stats
+
+    def histograms(self) -> Dict[int, LatencyHistogram]:
+        return {id: stats.latency for id, stats in self._devices.items()}
+
+    def bus_histogram(self) -> LatencyHistogram:
+        return self._bus
+
+    def _timeout(self, latency: LatencyHistogram) -> float:
+        if latency.count < self.min_samples:
+            latency = self._bus
+        if latency.count < self.min_samples:
+            return self.initial_timeout
+        return min(max(latency.quantile(self.quantile) * self.margin,
+                       self.min_timeout), self.max_timeout)
+
+    def timeout(self, id: int, attempt: int = 0) -> float:
+        stats = self.stats(id)
+        # walking the buckets on every read is a waste, the quantile barely
+        # moves from one reply to the next
+        if stats.timeout == 0.0 or stats.stale >= self.refresh:
+            stats.timeout = self._timeout(stats.latency)
+            stats.stale = 0
+        return stats.timeout * self.timeout_factor ** attempt
+
+    # wait before retry `attempt` (counted from 1)
+    def delay(self, attempt: int) -> float:
+        return self.backoff * self.backoff_factor ** (attempt - 1)
+
+    # False while the circuit is open, or half open with its try in flight
+    def available(self, id: int) -> bool:
+        stats = self.stats(id)
+        return perf_counter() >= stats.open_until and not stats.probe
+
+    # a half open circuit lets a single try through: True for the caller
+    # that gets it, until its reply or timeout is recorded
+    def probing(self, id: int) -> bool:
+        stats = self.stats(id)
+        if stats.failures < self.failure_threshold or not self.available(id):
+            return False
+        stats.probe = True
+        return True
+
+    def record_reply(self, id: int, latency: float):
+        stats = self.stats(id)
+        stats.latency.record(latency)
+        self._bus.record(latency)
+        stats.replies += 1
+        stats.stale += 1
+        stats.failures = 0
+        stats.cooldown = 0.0
+        stats.open_until = 0.0
+        stats.probe = False
+
+    # returns True when the circuit has just been opened
+    def record_timeout(self, id: int) -> bool:
+        stats = self.stats(id)
+        stats.timeouts += 1
+        stats.failures += 1
+        stats.probe = False
+        # the other reads in flight when the circuit opened time out too
+        if stats.failures < self.failure_threshold or not self.available(id):
+            return False
+        stats.cooldown = min(stats.cooldown * 2, self.max_cooldown) \
+            if stats.cooldown else self.cooldown
+        stats.open_until = perf_counter() + stats.cooldown
+        return True
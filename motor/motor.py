@@ -3,8 +3,10 @@ from .pkt import *
 from typing import Optional
 from .protocol import MotorProtocol, Direction
 from .utils import Instant
+from .scheduler import FixedRateScheduler
 from loguru import logger
 import asyncio
+from time import perf_counter
 from typing import Optional, Tuple, Union
 
 
@@ -22,19 +24,52 @@ def degree_to_pulse(degree: float, division: int, step_angle: float = 1.8):
     # origin_div = 360 / step_angle
     # enhanced_div = origin_div * division
     # one_deg_pulse = enhanced_div / 360
-    one_deg_pulse = step_angle / division
-    return int(degree * one_deg_pulse)
+    one_deg_pulse = division / step_angle
+    return round(degree * one_deg_pulse)
+
+
+def pulse_to_degree(pulse: int, division: int, step_angle: float = 1.8):
+    return pulse * step_angle / division
+
+
+# Vrpm = (speed * 30000) / (division * 200)
+# i.e. 500 pulses per second for each speed level, whatever the division
+PULSE_RATE_PER_SPEED = 500
+
+
+def speed_to_pulse_rate(speed: int) -> float:
+    return speed * PULSE_RATE_PER_SPEED
+
+
+def pulse_rate_to_speed(pulse_rate: float) -> int:
+    return min(max(round(abs(pulse_rate) / PULSE_RATE_PER_SPEED), 0), SPEED_MAX)
+
+
+# seconds a `CTRL_SPEED_WITH_PULSE_CNT` move takes. Level 0 still turns (see
+# `Motor.delta_degree`), taken as fast as level 1
+def move_duration(speed: int, pulse: int) -> float:
+    return abs(pulse) / speed_to_pulse_rate(max(speed, 1))
 
 
 class Motor:
     id: int
     protocol: MotorProtocol
-    last_position_deg: Optional[float] 
+    # dead reckoned from the pulses sent so far and re-synchronised from the
+    # encoder (see `sync`). None until the first reading
+    last_position_deg: Optional[float]
     last_write: Instant
     degree_max: Optional[float]
     degree_min: Optional[float]
     division: int
+    # a reading further than this from the estimation is reported as drift
+    drift_tolerance_deg: float
+    last_drift_deg: Optional[float]
     _positive_direction: Direction
+    # bumped on every move, so that a reading taken across a move is ignored
+    _move_seq: int
+    # `perf_counter()` when the last move should be done, inf in velocity mode
+    _move_end: float
+    _sync_task: Optional[asyncio.Task]
 
     def __init__(self, id: int, protocol: MotorProtocol, division: int = 16) -> None:
         MAX_POS_ABS = 18
@@ -45,8 +80,13 @@ class Motor:
         self.degree_max = None
         self.degree_min = None
         self.division = division
+        self.drift_tolerance_deg = 0.5
+        self.last_drift_deg = None
         self.protocol.register_device(self.id)
         self._positive_direction = Direction.CW
+        self._move_seq = 0
+        self._move_end = 0.0
+        self._sync_task = None
 
     def set_positive_direction(self, direction: Direction):
         self._positive_direction = direction
@@ -60,27 +100,58 @@ class Motor:
         self.division = division
         self.protocol.set_division(self.id, division)
 
-    def to_degree(self, speed:int, degree:float):
-        assert self.last_position_deg is not None
+    def _clamp(self, degree: float) -> float:
         if self.degree_max is not None and degree > self.degree_max:
             degree = self.degree_max
         if self.degree_min is not None and degree < self.degree_min:
             degree = self.degree_min
-        delta_angle = degree - self.last_position_deg
-        delta_pulse = degree_to_pulse(delta_angle, self.division)
-        self.protocol.ctrl_speed_with_pulse_count(
-            self.id, Direction.CW, speed, delta_pulse)
+        return degree
 
-    async def to_degree_with_new_reading(self, speed: int, degree: float, timeout=0.1, max_retry_times=3):
-        self.last_position_deg = await self.protocol.read_position_deg(self.id, timeout=timeout, max_retry_times=max_retry_times)
-        if self.degree_max is not None and degree > self.degree_max:
-            degree = self.degree_max
-        if self.degree_min is not None and degree < self.degree_min:
-            degree = self.degree_min
-        delta_angle = degree - self.last_position_deg
-        delta_pulse = degree_to_pulse(delta_angle, self.division)
+    # the position reported by the controller grows in clockwise direction,
+    # the degrees of `Motor` in the positive direction: negated for a motor
+    # set to CCW positive
+    def _reading_to_degree(self, reading_deg: float) -> float:
+        return reading_deg if self._positive_direction == Direction.CW else -reading_deg
+
+    # move by `pulse` (signed, positive in the positive direction) and advance
+    # the estimation by what has actually been sent, so the rounding of each
+    # move doesn't add up
+    def move_pulse(self, speed: int, pulse: int):
+        if pulse == 0:
+            return
+        direction = self._positive_direction if pulse > 0 else reverse_direction(
+            self._positive_direction)
         self.protocol.ctrl_speed_with_pulse_count(
-            self.id, Direction.CW, speed, delta_pulse)
+            self.id, direction, speed, abs(pulse))
+        if self.last_position_deg is not None:
+            self.last_position_deg += pulse_to_degree(pulse, self.division)
+        self._move_seq += 1
+        # a new move replaces the one running
+        self._move_end = perf_counter() + move_duration(speed, pulse)
+        self.last_write.reset()
+
+    # velocity mode, `speed` is signed (positive in the positive direction).
+    # The motor runs until told otherwise, so the estimated position is lost
+    # until the next `sync`/`get_degree`
+    def run_speed(self, speed: float):
+        direction = self._positive_direction if speed >= 0 else reverse_direction(
+            self._positive_direction)
+        self.protocol.ctrl_speed(self.id, direction,
+                                 min(int(abs(speed)), SPEED_MAX))
+        self.last_position_deg = None
+        self._move_seq += 1
+        self._move_end = float("inf") if int(abs(speed)) else perf_counter()
+        self.last_write.reset()
+
+    # absolute move from the estimated position, without reading the encoder
+    def to_degree(self, speed: int, degree: float):
+        assert self.last_position_deg is not None
+        delta_angle = self._clamp(degree) - self.last_position_deg
+        self.move_pulse(speed, degree_to_pulse(delta_angle, self.division))
+
+    async def to_degree_with_new_reading(self, speed: int, degree: float, timeout: Optional[float] = None, max_retry_times: int = 3):
+        await self.get_degree(timeout, max_retry_times)
+        self.to_degree(speed, degree)
 
     def delta_degree(self, speed: int, delta_deg: float):
         # 在 16 细分下，发送 e0 fd 00 0c 80，表示电机以 0 档速度正转 360°
@@ -109,23 +180,65 @@ class Motor:
 
         # 支持 1~256 任意细分
         # 设置细分步数(默认16细分)
-        assert self.last_position_deg is not None
-        self.last_position_deg = self.last_position_deg + delta_deg
-        pulse = abs(degree_to_pulse(delta_deg, self.division)) 
-        direction = self._positive_direction if delta_deg > 0 else reverse_direction(
-            self._positive_direction)
-        self.protocol.ctrl_speed_with_pulse_count(
-            self.id, direction, speed, pulse)
+        self.move_pulse(speed, degree_to_pulse(delta_deg, self.division))
 
     def set_degree_range(self, degree_min: float, degree_max: float):
         assert degree_min < degree_max
         self.degree_min = degree_min
         self.degree_max = degree_max
 
-    async def get_degree(self, timeout=0.1, max_retry_times=3):
-        self.last_position_deg = await self.protocol.read_position_deg(self.id, timeout, max_retry_times)
+    # whether the last move should still be running `margin` seconds from now
+    def moving(self, margin: float = 0.0) -> bool:
+        return perf_counter() + margin < self._move_end
+
+    # in the positive direction, see `_reading_to_degree`
+    async def get_degree(self, timeout: Optional[float] = None, max_retry_times: int = 3):
+        reading = await self.protocol.read_position_deg(self.id, timeout, max_retry_times)
+        self.last_position_deg = self._reading_to_degree(reading)
         return self.last_position_deg
 
+    # read the encoder and replace the estimation with it. Returns the drift
+    # (reading - estimation), or None if there was nothing to compare to, the
+    # last move isn't done yet or the motor was commanded while reading
+    async def sync(self, timeout: Optional[float] = None, max_retry_times: int = 3) -> Optional[float]:
+        if self.moving():
+            return None
+        seq = self._move_seq
+        reading = await self.protocol.read_position_deg(self.id, timeout, max_retry_times)
+        if seq != self._move_seq:
+            return None
+        measured = self._reading_to_degree(reading)
+        estimated = self.last_position_deg
+        self.last_position_deg = measured
+        if estimated is None:
+            return None
+        drift = measured - estimated
+        self.last_drift_deg = drift
+        if abs(drift) > self.drift_tolerance_deg:
+            logger.warning("[{:02x}] drift {:.3f} deg".format(self.id, drift))
+        return drift
+
+    # re-synchronise in the background every `interval` seconds, once the
+    # last move should have been done (from its pulses and speed) for
+    # `settle_time` seconds
+    def start_sync(self, interval: float = 0.5, settle_time: float = 0.2, timeout: Optional[float] = None, max_retry_times: int = 3):
+        async def tick(dt: float):
+            if self.moving(-settle_time):
+                return
+            try:
+                await self.sync(timeout, max_retry_times)
+            except IOError as e:
+                logger.warning("[{:02x}] sync failed: {}".format(self.id, e))
+
+        self.stop_sync()
+        self._sync_task = asyncio.create_task(
+            FixedRateScheduler(1 / interval, tick).run())
+
+    def stop_sync(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+
 
 class RotateTiltMotor:
     rotate_motor: Motor
@@ -141,16 +254,24 @@ class RotateTiltMotor:
 
     # https://stackoverflow.com/questions/34377319/combine-awaitables-like-promise-all
     async def delta_degree(self, speed: int, rotate_delta: float, tilt_delta: float):
-        self.rotate_motor.delta_degree(speed, rotate_delta)
-        await asyncio.sleep(0.0025)
-        self.tilt_motor.delta_degree(speed, tilt_delta)
+        # the packets of both axes leave in a single write (or spaced by the
+        # protocol's inter frame gap) when the batch ends
+        with self.rotate_motor.protocol.batch(), self.tilt_motor.protocol.batch():
+            self.rotate_motor.delta_degree(speed, rotate_delta)
+            self.tilt_motor.delta_degree(speed, tilt_delta)
+
+    def run_speed(self, rotate_speed: float, tilt_speed: float):
+        with self.rotate_motor.protocol.batch(), self.tilt_motor.protocol.batch():
+            self.rotate_motor.run_speed(rotate_speed)
+            self.tilt_motor.run_speed(tilt_speed)
 
     def to_degree(self, speed: int, rotate_degree: float, tilt_degree: float):
-        self.rotate_motor.to_degree(speed, rotate_degree)
-        self.tilt_motor.to_degree(speed, tilt_degree)
+        with self.rotate_motor.protocol.batch(), self.tilt_motor.protocol.batch():
+            self.rotate_motor.to_degree(speed, rotate_degree)
+            self.tilt_motor.to_degree(speed, tilt_degree)
 
-    async def to_degree_with_new_reading(self, speed: int, rotate_degree: float, tilt_degree: float, timeout=0.1, max_retry_times=3):
-        asyncio.gather(
+    async def to_degree_with_new_reading(self, speed: int, rotate_degree: float, tilt_degree: float, timeout: Optional[float] = None, max_retry_times: int = 3):
+        await asyncio.gather(
             self.rotate_motor.to_degree_with_new_reading(speed, rotate_degree, timeout, max_retry_times),
             self.tilt_motor.to_degree_with_new_reading(speed, tilt_degree, timeout, max_retry_times),
         )
@@ -159,8 +280,10 @@ class RotateTiltMotor:
         self.rotate_motor.set_degree_range(*rotate_degree_range)
         self.tilt_motor.set_degree_range(*tilt_degree_range)
 
-    async def get_degree(self, timeout=0.1, max_retry_times=3):
-        # should not get the degree at the same time
-        r = await self.rotate_motor.get_degree(timeout, max_retry_times)
-        t = await self.tilt_motor.get_degree(timeout, max_retry_times)
+    async def get_degree(self, timeout: Optional[float] = None, max_retry_times: int = 3):
+        # both reads are in flight at once and matched in request order
+        r, t = await asyncio.gather(
+            self.rotate_motor.get_degree(timeout, max_retry_times),
+            self.tilt_motor.get_degree(timeout, max_retry_times),
+        )
         return (r, t)
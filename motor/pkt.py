@@ -1,6 +1,7 @@
 from enum import Enum, auto
 from .constant import *
 import struct
+from typing import Dict, Tuple
 
 
 class FlagWidth(Enum):
@@ -22,84 +23,135 @@ def get_flag_width(flag: int) -> FlagWidth:
         raise ValueError("invalid flag: {}".format(flag))
 
 
+# the format of every packet is known ahead, so the structs are compiled once
+# instead of formatting a new format string for each packet
+_HEADER: Dict[FlagWidth, struct.Struct] = {
+    FlagWidth.CHAR: struct.Struct(">BB"),
+    FlagWidth.SHORT: struct.Struct(">BH"),
+}
+# <device_id> <flag> <uint8_t>
+_U8_PKT = struct.Struct(">BBB")
+# <device_id> <flag> <direction&speed>[uint8_t] <pulse_count>[uint16_t]
+_SPEED_PULSE_PKT = struct.Struct(">BBBH")
+
+
 def serialize(id: int, flag: int, data: bytes):
     assert id >= 0 and id <= 255
-    fmt: str
-    # check if is python 3.10 or above
-    import sys
-    if sys.version_info >= (3, 10):
-        match get_flag_width(flag):
-            case FlagWidth.CHAR:
-                fmt = ">BB{}s".format(len(data))
-            case FlagWidth.SHORT:
-                fmt = ">BH{}s".format(len(data))
-            case _:
-                raise ValueError("invalid flag: {}".format(flag))
-    else:
-        if flag <= 0xff:
-            fmt = ">BB{}s".format(len(data))
-        elif flag <= 0xffff:
-            fmt = ">BH{}s".format(len(data))
-        else:
-            raise ValueError("invalid flag: {}".format(flag))
-    packet = struct.pack(fmt, id, flag, data)
-    return packet
+    return _HEADER[get_flag_width(flag)].pack(id, flag) + data
+
+
+# packets without parameters never change, so they are built once for every
+# possible id and shared (bytes are immutable)
+def _build_table(flag: int) -> Tuple[bytes, ...]:
+    return tuple(serialize(id, flag, b'') for id in range(256))
+
+
+_PKT_TABLE: Dict[int, Tuple[bytes, ...]] = {
+    flag: _build_table(flag) for flag in (
+        READ_ENCODER,
+        READ_INPUT_PULSE_COUNT,
+        READ_POSITION,
+        READ_POSITION_ERROR,
+        READ_EN_CLOSE_LOOP,
+        READ_STUCK_FLAG,
+        CTRL_STOP,
+        CTRL_SPEED_HOLD_S,
+        CTRL_SPEED_HOLD_CLR_S,
+    )
+}
+
+
+def cached_pkt(id: int, flag: int) -> bytes:
+    assert id >= 0 and id <= 255
+    return _PKT_TABLE[flag][id]
 
 
 def read_encoder_pkt(id: int):
-    return serialize(id, READ_ENCODER, b'')
+    return cached_pkt(id, READ_ENCODER)
 
 
 def read_input_pulse_count_pkt(id: int):
-    return serialize(id, READ_INPUT_PULSE_COUNT, b'')
+    return cached_pkt(id, READ_INPUT_PULSE_COUNT)
 
 
 def read_position_pkt(id: int):
-    return serialize(id, READ_POSITION, b'')
+    return cached_pkt(id, READ_POSITION)
 
 
 def read_position_error_pkt(id: int):
-    return serialize(id, READ_POSITION_ERROR, b'')
+    return cached_pkt(id, READ_POSITION_ERROR)
 
 
 def read_en_close_loop_pkt(id: int):
-    return serialize(id, READ_EN_CLOSE_LOOP, b'')
+    return cached_pkt(id, READ_EN_CLOSE_LOOP)
 
 
 def read_stuck_flag_pkt(id: int):
-    return serialize(id, READ_STUCK_FLAG, b'')
+    return cached_pkt(id, READ_STUCK_FLAG)
+
+
+def _speed_byte(direction: Direction, speed: int) -> int:
+    assert (speed >= 0 and speed < 128)
+    return ((direction.value & 0x01) << 7) | (speed & 0xff)
 
 
 def set_division_pkt(id: int, division: int):
     assert division >= 0 and division <= 255
-    return serialize(id, SET_DIVISION, struct.pack('>B', division))
+    return _U8_PKT.pack(id, SET_DIVISION, division)
 
 
 def ctrl_en_close_loop_pkt(id: int, en: bool):
-    return serialize(id, CTRL_EN_CLOSE_LOOP, struct.pack('>B', int(en)))
+    return _U8_PKT.pack(id, CTRL_EN_CLOSE_LOOP, int(en))
 
 
 def ctrl_speed_pkt(id: int, direction: Direction, speed: int):
-    direction_val = direction.value
-    assert (speed >= 0 and speed < 128)
-    s = ((direction_val & 0x01) << 7) | (speed & 0xff)
-    data = struct.pack('>B', s)
-    return serialize(id, CTRL_SPEED, data)
+    return _U8_PKT.pack(id, CTRL_SPEED, _speed_byte(direction, speed))
 
 
 def ctrl_speed_with_pulse_count_pkt(id: int, direction: Direction, speed: int, pulse_count: int):
-    assert (speed >= 0 and speed < 128)
-    s = ((direction.value & 0x01) << 7) | (speed & 0xff)
-    data = struct.pack('>BH', s, pulse_count)
-    return serialize(id, CTRL_SPEED_WITH_PULSE_CNT, data)
+    return _SPEED_PULSE_PKT.pack(id, CTRL_SPEED_WITH_PULSE_CNT, _speed_byte(direction, speed), pulse_count)
 
 
 def ctrl_stop_pkt(id: int):
-    return serialize(id, CTRL_STOP, b'')
+    return cached_pkt(id, CTRL_STOP)
 
 
 def ctrl_speed_hold_pkg(id: int, clear: bool = False):
     if clear:
-        serialize(id, CTRL_SPEED_HOLD_CLR_S, b'')
+        return cached_pkt(id, CTRL_SPEED_HOLD_CLR_S)
     else:
-        serialize(id, CTRL_SPEED_HOLD_S, b'')
+        return cached_pkt(id, CTRL_SPEED_HOLD_S)
+
+
+## pack_into
+# write the packet into a preallocated buffer (bytearray, memoryview, ...)
+# at `offset` and return the offset right after it
+
+def cached_pkt_into(buf, offset: int, id: int, flag: int) -> int:
+    pkt = cached_pkt(id, flag)
+    end = offset + len(pkt)
+    buf[offset:end] = pkt
+    return end
+
+
+def set_division_pkt_into(buf, offset: int, id: int, division: int) -> int:
+    assert division >= 0 and division <= 255
+    _U8_PKT.pack_into(buf, offset, id, SET_DIVISION, division)
+    return offset + _U8_PKT.size
+
+
+def ctrl_en_close_loop_pkt_into(buf, offset: int, id: int, en: bool) -> int:
+    _U8_PKT.pack_into(buf, offset, id, CTRL_EN_CLOSE_LOOP, int(en))
+    return offset + _U8_PKT.size
+
+
+def ctrl_speed_pkt_into(buf, offset: int, id: int, direction: Direction, speed: int) -> int:
+    _U8_PKT.pack_into(buf, offset, id, CTRL_SPEED,
+                      _speed_byte(direction, speed))
+    return offset + _U8_PKT.size
+
+
+def ctrl_speed_with_pulse_count_pkt_into(buf, offset: int, id: int, direction: Direction, speed: int, pulse_count: int) -> int:
+    _SPEED_PULSE_PKT.pack_into(buf, offset, id, CTRL_SPEED_WITH_PULSE_CNT,
+                               _speed_byte(direction, speed), pulse_count)
+    return offset + _SPEED_PULSE_PKT.size
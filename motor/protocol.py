@@ -1,22 +1,90 @@
 from loguru import logger
 import asyncio
-from asyncio_channel import create_channel
-from asyncio_channel._channel import Channel
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
 from .utils import hex_bytes
 from .pkt import *
-from typing import Any, Coroutine, Optional, Tuple, Union, List, Dict, Callable, TypeVar
+from .frame import FrameParser
+from .capture import CaptureWriter, EXPIRE, RX, TX
+from .latency import DeviceUnavailable, LatencyHistogram, RetryPolicy
+from typing import Any, Coroutine, Deque, Iterator, Optional, Set, Tuple, Union, List, Dict, Callable, TypeVar
 from serial_asyncio import SerialTransport
 
 T = TypeVar('T')
 
 
+# reply layouts, <device_id> <value>
+_U16_REPLY = struct.Struct("!BH")
+_U32_REPLY = struct.Struct("!BI")
+_I32_REPLY = struct.Struct("!Bi")
+
+
+class PendingRead:
+    # a read waiting for its reply, one per read
+    __slots__ = ("future", "deadline", "start", "timer")
+    future: "asyncio.Future[bytes]"
+    # in `loop.time()`
+    deadline: float
+    # `perf_counter()` when the read was submitted
+    start: float
+    timer: Optional[asyncio.TimerHandle]
+
+    def __init__(self, future: "asyncio.Future[bytes]", deadline: float, start: float) -> None:
+        self.future = future
+        self.deadline = deadline
+        self.start = start
+        self.timer = None
+
+
 class MotorProtocol(asyncio.Protocol):
-    _chans: Dict[int, Tuple[bool, Channel]]
+    _devices: Set[int]
+    # requests in flight, keyed by (device_id, command) and answered in
+    # FIFO order
+    _inflight: Dict[Tuple[int, int], Deque[PendingRead]]
+    _parser: FrameParser
+    # idle time (in seconds) the controller needs between two frames.
+    # 0 means frames can be sent back to back
+    inter_frame_gap: float
+    # whether the controllers answer `CTRL_SPEED_WITH_PULSE_CNT` with a start
+    # and a finish status frame, as the datasheet says
+    status_replies: bool
+    _batch: List[bytes]
+    _batch_depth: int
+    # frames waiting for the inter frame gap, sent in order by `_drain`.
+    # With a gap every frame is sent by `_send_next`, and until the frame and
+    # its gap have left the wire (`_drain_handle` is set) every write waits
+    # in here
+    _outgoing: Deque[bytes]
+    _drain_handle: Optional[asyncio.TimerHandle]
+    # records the raw traffic when set, see `motor.capture`
+    recorder: Optional[CaptureWriter]
+    # read timeouts, retries and round trip times, see `motor.latency`
+    policy: RetryPolicy
+    # bytes handed to / received from the transport
+    bytes_written: int
+    bytes_read: int
+    # stop the event loop when the port closes, what the single port scripts
+    # rely on. Off for the buses of a `BusManager`, which share the loop
+    stop_loop: bool
     transport: SerialTransport
 
-    def __init__(self) -> None:
+    def __init__(self, inter_frame_gap: float = 0.0, recorder: Optional[CaptureWriter] = None, policy: Optional[RetryPolicy] = None, status_replies: bool = True) -> None:
         super().__init__()
-        self._chans = {}
+        self.recorder = recorder
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.stop_loop = True
+        self._devices = set()
+        self._inflight = {}
+        self._parser = FrameParser()
+        self.inter_frame_gap = inter_frame_gap
+        self.status_replies = status_replies
+        self._batch = []
+        self._batch_depth = 0
+        self._outgoing = deque()
+        self._drain_handle = None
 
     def connection_made(self, transport: SerialTransport):
         self.transport = transport
@@ -24,20 +92,36 @@ class MotorProtocol(asyncio.Protocol):
         transport.serial.rts = False  # type: ignore
 
     def data_received(self, data):
-        logger.debug("[received] {}".format(hex_bytes(data)))
-        id = data[0]
-        if (id in self._chans):
-            ok, chan = self._chans[id]
-            if ok:
-                chan.offer(data)
-            else:
-                logger.warning("{:02x} channel not ready".format(id))
-        else:
-            logger.warning("{:02x} channel not registered".format(id))
+        self.bytes_read += len(data)
+        if self.recorder is not None:
+            self.recorder.write(RX, data)
+        logger.opt(lazy=True).debug("[received] {}", lambda: hex_bytes(data))
+        for id, cmd, frame in self._parser.feed(data):
+            if cmd is None:
+                logger.debug("[{:02x}] status {:02x}", id, frame[1])
+                continue
+            pending = self._inflight.get((id, cmd))
+            if not pending:
+                logger.warning(
+                    "[{:02x}] unexpected reply {}".format(id, hex_bytes(frame)))
+                continue
+            req = pending.popleft()
+            if req.timer is not None:
+                req.timer.cancel()
+            self.policy.record_reply(id, perf_counter() - req.start)
+            # the reader may have been cancelled in the meantime
+            if not req.future.done():
+                req.future.set_result(frame)
 
     def connection_lost(self, exc):
         logger.info('port closed')
-        self.transport.loop.stop()  # type: ignore
+        self._parser.clear()
+        if self._drain_handle is not None:
+            self._drain_handle.cancel()
+            self._drain_handle = None
+        self._outgoing.clear()
+        if self.stop_loop:
+            self.transport.loop.stop()  # type: ignore
 
     def pause_writing(self):
         logger.debug('pause writing; buffer size {}',
@@ -47,64 +131,180 @@ class MotorProtocol(asyncio.Protocol):
         logger.debug('resume writing; buffer size {}',
                      self.transport.get_write_buffer_size())  # type: ignore
 
+    # seconds to transmit a byte (1 start bit, 8 data bits, 1 stop bit)
+    def byte_time(self) -> float:
+        return 10 / self.transport.serial.baudrate  # type: ignore
+
+    def _transport_write(self, data: bytes):
+        self.bytes_written += len(data)
+        if self.recorder is not None:
+            self.recorder.write(TX, data)
+        self.transport.write(data)
+
+    def write(self, data: bytes):
+        if self._batch_depth > 0:
+            self._batch.append(data)
+        elif self._drain_handle is not None:
+            self._outgoing.append(data)
+        elif self.inter_frame_gap > 0:
+            self._send_next(data)
+        else:
+            self._transport_write(data)
+
+    # packets not handed to the transport yet: held back by an open batch or
+    # waiting for the inter frame gap
+    def batched_count(self) -> int:
+        return len(self._batch) + len(self._outgoing)
+
+    def begin_batch(self):
+        self._batch_depth += 1
+
+    def end_batch(self):
+        assert self._batch_depth > 0
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.flush()
+
+    # hold back every packet written in the block and send them at once when
+    # the outermost batch ends, e.g. once per control cycle
+    @contextmanager
+    def batch(self) -> Iterator["MotorProtocol"]:
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+    def flush(self):
+        frames = self._batch
+        if not frames:
+            return
+        self._batch = []
+        if self._drain_handle is not None:
+            # behind the frames still waiting
+            self._outgoing.extend(frames)
+        elif self.inter_frame_gap <= 0:
+            self._transport_write(b"".join(frames))
+        else:
+            # the gap can't be expressed inside a single write, so the
+            # following frames are queued and sent one by one once the
+            # previous one and its gap left the wire
+            self._outgoing.extend(frames[1:])
+            self._send_next(frames[0])
+
+    def _send_next(self, frame: bytes):
+        self._transport_write(frame)
+        delay = len(frame) * self.byte_time() + self.inter_frame_gap
+        self._drain_handle = asyncio.get_running_loop().call_later(delay, self._drain)
+
+    def _drain(self):
+        self._drain_handle = None
+        if self._outgoing:
+            self._send_next(self._outgoing.popleft())
+
     def register_device(self, id: int):
         logger.info("register device {:02x}".format(id))
-        self._chans[id] = (False, create_channel())
+        self._devices.add(id)
+        self._parser.register(id)
+
+    def inflight_count(self) -> int:
+        return sum(len(pending) for pending in self._inflight.values())
+
+    def latency(self, id: int) -> LatencyHistogram:
+        return self.policy.stats(id).latency
 
-    async def read_wrapper(self, id: int, write_action: Callable[[], None], result_handler: Callable[[bytes], T], timeout: float = 0.1) -> T:
-        if (id not in self._chans):
+    def _expire(self, key: Tuple[int, int], req: PendingRead):
+        pending = self._inflight.get(key)
+        if pending is not None and req in pending:
+            pending.remove(req)
+            self._parser.discard(*key)
+            if self.recorder is not None:
+                self.recorder.write(EXPIRE, bytes(key))
+            if self.policy.record_timeout(key[0]):
+                logger.warning("[{:02x}] not responding, circuit open for {:.2f}s".format(
+                    key[0], self.policy.stats(key[0]).cooldown))
+        if not req.future.done():
+            req.future.set_exception(IOError("read timeout"))
+
+    # put a read in flight, the request itself is up to the caller.
+    # Without timeout the request waits for its reply forever
+    def submit_read(self, id: int, cmd: int, timeout: Optional[float] = 0.1) -> PendingRead:
+        if (id not in self._devices):
             raise ValueError("device {:02x} not registered".format(id))
-        try:
-            _, chan = self._chans[id]
-            self._chans[id] = (True, chan)
-            write_action()
-            res = await self._chans[id][1].take(timeout=timeout)
-            if res == None:
-                raise IOError("read timeout")
-            assert isinstance(res, bytes)
-            self._chans[id] = (False, chan)
-            return result_handler(res)
-        except KeyboardInterrupt:
-            _, chan = self._chans[id]
-            self._chans[id] = (False, chan)
-            raise KeyboardInterrupt
-
-    async def retry_read_wrapper(self, fn: Callable[[], Coroutine[Any, Any, T]], max_retry_times: int = 3) -> T:
+        loop = asyncio.get_running_loop()
+        deadline = float("inf") if timeout is None else loop.time() + timeout
+        req = PendingRead(loop.create_future(), deadline, perf_counter())
+        key = (id, cmd)
+        pending = self._inflight.get(key)
+        if pending is None:
+            pending = self._inflight[key] = deque()
+        pending.append(req)
+        self._parser.expect(id, cmd)
+        if timeout is not None:
+            req.timer = loop.call_at(req.deadline, self._expire, key, req)
+        return req
+
+    # `cmd` is the command being sent, which tells the parser how long the
+    # reply is. Any number of reads (to the same or different devices) can be
+    # in flight at once; they are matched with the replies in request order.
+    async def read_wrapper(self, id: int, cmd: int, write_action: Callable[[], None], result_handler: Callable[[bytes], T], timeout: float = 0.1) -> T:
+        req = self.submit_read(id, cmd, timeout)
+        write_action()
+        return result_handler(await req.future)
+
+    # `fn` reads with the timeout it is given. Without `timeout` it comes from
+    # the round trip times of the device (see `RetryPolicy`), and a device
+    # that stopped answering fails at once instead of stalling the caller
+    async def retry_read_wrapper(self, id: int, fn: Callable[[float], Coroutine[Any, Any, T]], timeout: Optional[float] = None, max_retry_times: int = 3) -> T:
+        return await self._retry(id, fn, (), timeout, max_retry_times)
+
+    # the retries of every read: `fn(timeout, *args)` for each try, so the
+    # reads below don't build a closure per call
+    async def _retry(self, id: int, fn: Callable[..., Coroutine[Any, Any, T]], args: tuple, timeout: Optional[float], max_retry_times: int) -> T:
+        policy = self.policy
+        probe = policy.probing(id)
+        if probe:
+            max_retry_times = 1
         for i in range(max_retry_times):
+            if i > 0:
+                await asyncio.sleep(policy.delay(i))
+            if not probe and not policy.available(id):
+                raise DeviceUnavailable(
+                    "device {:02x} is not responding".format(id))
             try:
-                return await fn()
-            except IOError:
-                logger.warning(
-                    "retrying read {} for device {:02x}".format(i, id))
-        raise IOError("read failed for device {:02x}".format(id))
+                return await fn(policy.timeout(id, i) if timeout is None else timeout, *args)
+            except IOError as e:
+                logger.warning("[{:02x}] retrying read {}: {}".format(id, i, e))
+        raise IOError("read failed after {} tries".format(max_retry_times))
+
+    # a single try of the reads below, the packet comes from the cache
+    async def _read_once(self, timeout: float, id: int, cmd: int, reply: struct.Struct) -> int:
+        req = self.submit_read(id, cmd, timeout)
+        self.write(cached_pkt(id, cmd))
+        return reply.unpack(await req.future)[1]
 
-    async def read_encoder(self, id: int, timeout: float = 0.1, max_retry_times: int = 3):
-        def fn(): return self.read_wrapper(id, lambda: self.transport.write(read_encoder_pkt(id)),
-                                           lambda res: struct.unpack("!BH", res)[1], timeout=timeout)
-        return await self.retry_read_wrapper(fn, max_retry_times)
+    async def _read(self, id: int, cmd: int, reply: struct.Struct, timeout: Optional[float], max_retry_times: int) -> int:
+        return await self._retry(id, self._read_once, (id, cmd, reply), timeout, max_retry_times)
 
-    async def read_input_pulse_count(self, id: int, timeout=0.1, max_retry_times=3):
-        def fn(): return self.read_wrapper(id, lambda: self.transport.write(read_input_pulse_count_pkt(id)),
-                                           lambda res: struct.unpack("!BI", res)[1], timeout=timeout)
-        return await self.retry_read_wrapper(fn, max_retry_times)
+    async def read_encoder(self, id: int, timeout: Optional[float] = None, max_retry_times: int = 3):
+        return await self._read(id, READ_ENCODER, _U16_REPLY, timeout, max_retry_times)
+
+    async def read_input_pulse_count(self, id: int, timeout: Optional[float] = None, max_retry_times: int = 3):
+        return await self._read(id, READ_INPUT_PULSE_COUNT, _U32_REPLY, timeout, max_retry_times)
 
     # unit: max_uint16_t / 360
     # i.e. 65535 for a full circle
     # 655350 for 10 circles
-    async def read_position(self, id: int, timeout: float = 0.1, max_retry_times: int = 3):
-        def fn(): return self.read_wrapper(id, lambda: self.transport.write(read_position_pkt(id)),
-                                           lambda res: struct.unpack("!Bi", res)[1], timeout=timeout)
-        return await self.retry_read_wrapper(fn, max_retry_times)
+    async def read_position(self, id: int, timeout: Optional[float] = None, max_retry_times: int = 3):
+        return await self._read(id, READ_POSITION, _I32_REPLY, timeout, max_retry_times)
 
-    async def read_position_deg(self, id: int, timeout: float = 0.1, max_retry_times: int = 3):
+    async def read_position_deg(self, id: int, timeout: Optional[float] = None, max_retry_times: int = 3):
         pos = await self.read_position(id, timeout=timeout, max_retry_times=max_retry_times)
         return pos / 65535 * 360
 
     # unit: max_uint16_t / 360
-    async def read_position_err(self, id: int, timeout: float = 0.1, max_retry_times: int = 3):
-        def fn(): return self.read_wrapper(id, lambda: self.transport.write(read_position_error_pkt(id)),
-                                           lambda res: struct.unpack("!BH", res)[1], timeout=timeout)
-        return await self.retry_read_wrapper(fn, max_retry_times)
+    async def read_position_err(self, id: int, timeout: Optional[float] = None, max_retry_times: int = 3):
+        return await self._read(id, READ_POSITION_ERROR, _U16_REPLY, timeout, max_retry_times)
 
     # 0: error
     # 1: enabled
@@ -118,26 +318,28 @@ class MotorProtocol(asyncio.Protocol):
     def ctrl_speed(self, id: int, direction: Direction, speed: int):
         speed = int(speed)
         data = ctrl_speed_pkt(id, direction, speed)
-        logger.debug("[{:02x}] direction:{} speed:{}".format(
-            id, direction, speed))
-        self.transport.write(data)
+        logger.debug("[{:02x}] direction:{} speed:{}",
+                     id, direction, speed)
+        self.write(data)
 
     def ctrl_en_close_loop(self, id: int, en: bool):
         data = ctrl_en_close_loop_pkt(id, en)
-        self.transport.write(data)
+        self.write(data)
 
     def ctrl_stop(self, id: int):
         data = ctrl_stop_pkt(id)
-        self.transport.write(data)
+        self.write(data)
 
     def ctrl_speed_with_pulse_count(self, id: int, direction: Direction, speed: int, pulse_count: int):
         assert (pulse_count > 0)
         data = ctrl_speed_with_pulse_count_pkt(
             id, direction, speed, pulse_count)
-        logger.debug("[{:02x}] direction:{} speed:{} pulse_count:{}".format(
-            id, direction, speed, pulse_count))
-        self.transport.write(data)
+        logger.debug("[{:02x}] direction:{} speed:{} pulse_count:{}",
+                     id, direction, speed, pulse_count)
+        if self.status_replies and id in self._devices:
+            self._parser.expect_status(id)
+        self.write(data)
 
     def set_division(self, id: int, division: int):
         data = set_division_pkt(id, division)
-        self.transport.write(data)
+        self.write(data)
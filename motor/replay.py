@@ -0,0 +1,136 @@
+import asyncio
+import struct
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from .constant import *
+from .capture import EXPIRE, RX, TX, Record, read_capture
+from .frame import split_requests
+from .motor import Motor
+from .protocol import MotorProtocol, PendingRead
+from typing import Dict, List, Tuple
+
+
+class _NullTransport(asyncio.Transport):
+    # the packets `Motor` sends while replaying go nowhere
+    def __init__(self, baudrate: int) -> None:
+        super().__init__()
+        self.serial = SimpleNamespace(baudrate=baudrate, rts=False)
+
+    def write(self, data):
+        pass
+
+
+@dataclass
+class ReplayStats:
+    records: int = 0
+    tx_bytes: int = 0
+    rx_bytes: int = 0
+    # replies matched with a replayed request
+    replies: int = 0
+    # requests that timed out in the live run
+    expired: int = 0
+    # requests still waiting for a reply at the end of the capture
+    unanswered: int = 0
+    # reading - estimation of each position reply, per device
+    drift: Dict[int, List[float]] = field(default_factory=dict)
+
+
+class Replayer:
+    """
+    Feed a capture back through `MotorProtocol` (frame parser, in-flight
+    table) and `Motor` (dead reckoning): the requests sent are replayed as
+    reads in flight and moves, the bytes received as `data_received` and the
+    timeouts of the live run (EXPIRE records) as expired reads.
+    """
+    protocol: MotorProtocol
+    motors: Dict[int, Motor]
+    stats: ReplayStats
+    _pending: List[Tuple[int, int, PendingRead]]
+
+    def __init__(self, baudrate: int = 38400) -> None:
+        self.protocol = MotorProtocol()
+        self.protocol.connection_made(
+            _NullTransport(baudrate))  # type: ignore
+        self.motors = {}
+        self.stats = ReplayStats()
+        self._pending = []
+
+    def _motor(self, id: int) -> Motor:
+        motor = self.motors.get(id)
+        if motor is None:
+            motor = self.motors[id] = Motor(id, self.protocol)
+        return motor
+
+    def _replay_request(self, frame: bytes):
+        id, cmd = frame[0], frame[1]
+        if id == BROADCAST_ADDR:
+            return
+        motor = self._motor(id)
+        if cmd in REPLY_SIZE:
+            req = self.protocol.submit_read(id, cmd, timeout=None)
+            self._pending.append((id, cmd, req))
+        elif cmd == SET_DIVISION:
+            motor.division = frame[2]
+        elif cmd == CTRL_SPEED:
+            motor.last_position_deg = None
+        elif cmd == CTRL_SPEED_WITH_PULSE_CNT:
+            pulse_count, = struct.unpack(">H", frame[3:5])
+            # the direction bit is set for CCW, the default negative direction
+            sign = -1 if frame[2] & 0x80 else 1
+            motor.move_pulse(frame[2] & 0x7f, sign * pulse_count)
+
+    def _collect(self):
+        pending = []
+        for id, cmd, req in self._pending:
+            if not req.future.done():
+                pending.append((id, cmd, req))
+                continue
+            if req.future.exception() is not None:
+                self.stats.expired += 1
+                continue
+            self.stats.replies += 1
+            if cmd != READ_POSITION:
+                continue
+            motor = self.motors[id]
+            reading = struct.unpack("!Bi", req.future.result())[1]
+            measured = motor._reading_to_degree(reading / 65535 * 360)
+            if motor.last_position_deg is not None:
+                self.stats.drift.setdefault(id, []).append(
+                    measured - motor.last_position_deg)
+            motor.last_position_deg = measured
+        self._pending = pending
+
+    def feed(self, record: Record):
+        self.stats.records += 1
+        if record.direction == TX:
+            self.stats.tx_bytes += len(record.data)
+            frames, _ = split_requests(record.data)
+            for frame in frames:
+                self._replay_request(frame)
+        elif record.direction == RX:
+            self.stats.rx_bytes += len(record.data)
+            self.protocol.data_received(record.data)
+            self._collect()
+        elif record.direction == EXPIRE:
+            key = (record.data[0], record.data[1])
+            inflight = self.protocol._inflight.get(key)
+            # the oldest one, as on the live side
+            if inflight:
+                self.protocol._expire(key, inflight[0])
+            self._collect()
+
+    # with `realtime` the records are fed with their original spacing
+    async def run(self, path: str, realtime: bool = False) -> ReplayStats:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first_ns = None
+        for record in read_capture(path):
+            if realtime:
+                if first_ns is None:
+                    first_ns = record.time_ns
+                delay = start + (record.time_ns - first_ns) / 1e9 - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.feed(record)
+        self.stats.unanswered = len(self._pending)
+        return self.stats
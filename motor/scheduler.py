@@ -0,0 +1,118 @@
+import asyncio
+from dataclasses import dataclass
+from enum import Enum, auto
+from time import perf_counter_ns
+from typing import Awaitable, Callable, Optional, Union
+
+
+class LatePolicy(Enum):
+    # drop the slots that have entirely passed and run the latest one right
+    # away, staying on the original grid (keeps the phase)
+    SKIP = auto()
+    # run the missed slots as one tick right away and restart the grid from
+    # there
+    MERGE = auto()
+
+
+@dataclass
+class TickStats:
+    ticks: int = 0
+    # ticks whose work took longer than the period
+    overruns: int = 0
+    # slots dropped (SKIP) or folded into a late tick (MERGE)
+    missed: int = 0
+    # how late a tick started compared to its slot, in seconds
+    jitter_sum: float = 0.0
+    jitter_max: float = 0.0
+    # time spent in the tick itself, in seconds
+    busy_sum: float = 0.0
+    busy_max: float = 0.0
+
+    @property
+    def jitter_mean(self) -> float:
+        return self.jitter_sum / self.ticks if self.ticks else 0.0
+
+    @property
+    def busy_mean(self) -> float:
+        return self.busy_sum / self.ticks if self.ticks else 0.0
+
+    def __str__(self) -> str:
+        return "ticks:{} overruns:{} missed:{} jitter:{:.2f}/{:.2f}ms busy:{:.2f}/{:.2f}ms (mean/max)".format(
+            self.ticks, self.overruns, self.missed,
+            self.jitter_mean * 1e3, self.jitter_max * 1e3,
+            self.busy_mean * 1e3, self.busy_max * 1e3)
+
+
+# the tick gets the time elapsed since the previous tick in seconds
+TickFn = Callable[[float], Union[None, Awaitable[None]]]
+
+
+class FixedRateScheduler:
+    """
+    Run `tick` at a fixed rate on the event loop.
+
+    Deadlines are laid on a grid of `loop.time()` so that the sleeps don't
+    accumulate drift. `flush` (e.g. `MotorProtocol.flush`) is called after
+    every tick, so the commands of a whole cycle leave in one go.
+    """
+    period: float
+    policy: LatePolicy
+    stats: TickStats
+    _tick: TickFn
+    _flush: Optional[Callable[[], None]]
+    _running: bool
+
+    def __init__(self, rate: float, tick: TickFn, policy: LatePolicy = LatePolicy.SKIP, flush: Optional[Callable[[], None]] = None) -> None:
+        assert rate > 0
+        self.period = 1 / rate
+        self.policy = policy
+        self.stats = TickStats()
+        self._tick = tick
+        self._flush = flush
+        self._running = False
+
+    def stop(self):
+        self._running = False
+
+    async def run(self, max_ticks: Optional[int] = None):
+        loop = asyncio.get_running_loop()
+        period = self.period
+        stats = self.stats
+        self._running = True
+        deadline = loop.time()
+        last: Optional[float] = None
+        while self._running and (max_ticks is None or stats.ticks < max_ticks):
+            now = loop.time()
+            if now < deadline:
+                await asyncio.sleep(deadline - now)
+                now = loop.time()
+            late = max(now - deadline, 0.0)
+            dt = period if last is None else now - last
+            last = now
+
+            start = perf_counter_ns()
+            res = self._tick(dt)
+            if res is not None:
+                await res
+            if self._flush is not None:
+                self._flush()
+            busy = (perf_counter_ns() - start) / 1e9
+
+            stats.ticks += 1
+            stats.jitter_sum += late
+            stats.jitter_max = max(stats.jitter_max, late)
+            stats.busy_sum += busy
+            stats.busy_max = max(stats.busy_max, busy)
+            if busy > period:
+                stats.overruns += 1
+
+            deadline += period
+            now = loop.time()
+            if now > deadline:
+                # slots that are entirely in the past
+                missed = int((now - deadline) // period)
+                if self.policy == LatePolicy.SKIP:
+                    deadline += missed * period
+                else:
+                    deadline = now
+                stats.missed += missed
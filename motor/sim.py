@@ -0,0 +1,280 @@
+import asyncio
+import random
+import struct
+from types import SimpleNamespace
+from loguru import logger
+from .constant import *
+from .motor import speed_to_pulse_rate
+from .frame import split_requests
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+P = TypeVar('P', bound=asyncio.Protocol)
+
+
+class SimMotor:
+    """
+    A stepper with its closed loop controller. The motion is evaluated lazily
+    from the last command, positions are kept in (fractional) pulses and
+    positive means clockwise. A `CTRL_SPEED_WITH_PULSE_CNT` at speed level 0
+    still runs its pulses (the datasheet note in `Motor.delta_degree`), taken
+    as fast as level 1; a `CTRL_SPEED` at level 0 stands still.
+    """
+    id: int
+    division: int
+    step_angle: float
+    close_loop: bool
+    input_pulse_count: int
+    # motion since the last command
+    _t0: float
+    _pos0: float
+    # pulses per second, signed
+    _velocity: float
+    _target: Optional[float]
+
+    def __init__(self, id: int, division: int = 16, step_angle: float = 1.8) -> None:
+        self.id = id
+        self.division = division
+        self.step_angle = step_angle
+        self.close_loop = True
+        self.input_pulse_count = 0
+        self._t0 = 0.0
+        self._pos0 = 0.0
+        self._velocity = 0.0
+        self._target = None
+
+    def position(self, now: float) -> float:
+        pos = self._pos0 + self._velocity * (now - self._t0)
+        if self._target is not None:
+            if (self._velocity > 0 and pos >= self._target) or (self._velocity < 0 and pos <= self._target):
+                return self._target
+        return pos
+
+    def moving(self, now: float) -> bool:
+        return self._velocity != 0 and (self._target is None or self.position(now) != self._target)
+
+    # seconds until the current move is done, None if it never ends
+    def remaining(self, now: float) -> Optional[float]:
+        if self._velocity == 0:
+            return 0.0
+        if self._target is None:
+            return None
+        return max((self._target - self.position(now)) / self._velocity, 0.0)
+
+    def _rebase(self, now: float):
+        self._pos0 = self.position(now)
+        self._t0 = now
+        if self._target is not None and self._pos0 == self._target:
+            self._velocity = 0.0
+            self._target = None
+
+    def speed(self, now: float, speed_byte: int):
+        self._rebase(now)
+        sign = -1 if speed_byte & 0x80 else 1
+        self._velocity = sign * speed_to_pulse_rate(speed_byte & 0x7f)
+        self._target = None
+
+    def move(self, now: float, speed_byte: int, pulse_count: int):
+        self._rebase(now)
+        sign = -1 if speed_byte & 0x80 else 1
+        # speed 0 is the slowest gear, not a stop
+        self._velocity = sign * speed_to_pulse_rate(max(speed_byte & 0x7f, 1))
+        self._target = self._pos0 + sign * pulse_count
+        self.input_pulse_count += pulse_count
+
+    def stop(self, now: float):
+        self._rebase(now)
+        self._velocity = 0.0
+        self._target = None
+
+    # max_uint16_t per turn
+    def reading(self, now: float) -> int:
+        return int(self.position(now) * self.step_angle / self.division / 360 * 65536)
+
+    def reply(self, now: float, cmd: int) -> Optional[bytes]:
+        if cmd == READ_ENCODER:
+            return struct.pack(">BH", self.id, self.reading(now) & 0xffff)
+        if cmd == READ_INPUT_PULSE_COUNT:
+            return struct.pack(">BI", self.id, self.input_pulse_count & 0xffffffff)
+        if cmd == READ_POSITION:
+            return struct.pack(">Bi", self.id, self.reading(now))
+        if cmd == READ_POSITION_ERROR:
+            # the loop lags about a millisecond behind while moving
+            lag = 0
+            if self.moving(now):
+                lag = int(self._velocity * 1e-3 * self.step_angle /
+                          self.division / 360 * 65536)
+            return struct.pack(">BH", self.id, max(min(lag, 0x7fff), -0x8000) & 0xffff)
+        if cmd == READ_EN_CLOSE_LOOP:
+            return struct.pack(">BB", self.id, 1 if self.close_loop else 2)
+        if cmd == READ_STUCK_FLAG:
+            return struct.pack(">BB", self.id, 0)
+        return None
+
+
+class SimTransport(asyncio.Transport):
+    """
+    In process stand-in for the serial port and the controllers behind it.
+
+    Both directions of the line are serialised at `baudrate` (10 bits per
+    byte). The received bytes are handed to the protocol as they would be
+    read from the port: everything that arrived by the time the loop gets to
+    it, so replies are split and coalesced just like on the real thing.
+
+    `loss` is the probability that a request is lost on the way. With
+    `status_replies` (as the real controllers do, and `MotorProtocol`
+    expects by default) the `CTRL_SPEED_WITH_PULSE_CNT` start and finish
+    status frames are sent too.
+    """
+    serial: SimpleNamespace
+    motors: Dict[int, SimMotor]
+    response_delay: float
+    loss: float
+    status_replies: bool
+    _loop: asyncio.AbstractEventLoop
+    _protocol: asyncio.Protocol
+    _random: random.Random
+    _tx: bytearray
+    # when the line of each direction is free again, in `loop.time()`
+    _tx_free_at: float
+    _rx_free_at: float
+    # (arrival time, byte) not yet handed to the protocol
+    _rx_pending: List[Tuple[float, int]]
+    _rx_handle: Optional[asyncio.TimerHandle]
+    _closing: bool
+    bytes_written: int
+    bytes_read: int
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, protocol: asyncio.Protocol, motors: Iterable[SimMotor], baudrate: int = 38400, response_delay: float = 5e-4, loss: float = 0.0, status_replies: bool = True, seed: Optional[int] = None) -> None:
+        super().__init__()
+        self.serial = SimpleNamespace(baudrate=baudrate, rts=False)
+        self.motors = {m.id: m for m in motors}
+        self.response_delay = response_delay
+        self.loss = loss
+        self.status_replies = status_replies
+        self._loop = loop
+        self._protocol = protocol
+        self._random = random.Random(seed)
+        self._tx = bytearray()
+        self._tx_free_at = 0.0
+        self._rx_free_at = 0.0
+        self._rx_pending = []
+        self._rx_handle = None
+        self._closing = False
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def byte_time(self) -> float:
+        return 10 / self.serial.baudrate
+
+    # when everything written so far has left the host
+    @property
+    def tx_free_at(self) -> float:
+        return self._tx_free_at
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        if self._rx_handle is not None:
+            self._rx_handle.cancel()
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+    def write(self, data: bytes):
+        if self._closing:
+            return
+        now = self._loop.time()
+        start = max(now, self._tx_free_at)
+        self._tx_free_at = start + len(data) * self.byte_time()
+        self.bytes_written += len(data)
+        # handled right away as of the time the request is through, which
+        # saves a timer (and its latency) per write
+        self._on_request(data, self._tx_free_at)
+
+    def _on_request(self, data: bytes, at: float):
+        self._tx += data
+        frames, consumed = split_requests(self._tx)
+        del self._tx[:consumed]
+        for frame in frames:
+            if self.loss > 0 and self._random.random() < self.loss:
+                continue
+            self._handle(frame, at)
+
+    def _handle(self, frame: bytes, now: float):
+        id, cmd = frame[0], frame[1]
+        if id == BROADCAST_ADDR:
+            targets = list(self.motors.values())
+        elif id in self.motors:
+            targets = [self.motors[id]]
+        else:
+            return
+        for motor in targets:
+            if cmd == SET_DIVISION:
+                motor.division = frame[2]
+            elif cmd == CTRL_EN_CLOSE_LOOP:
+                motor.close_loop = bool(frame[2])
+            elif cmd == CTRL_SPEED:
+                motor.speed(now, frame[2])
+            elif cmd == CTRL_STOP:
+                motor.stop(now)
+            elif cmd == CTRL_SPEED_WITH_PULSE_CNT:
+                pulse_count, = struct.unpack(">H", frame[3:5])
+                motor.move(now, frame[2], pulse_count)
+                if self.status_replies and id != BROADCAST_ADDR:
+                    self._reply(bytes([id, STATUS_START]), now)
+                    finish = now + (motor.remaining(now) or 0.0)
+                    self._loop.call_at(finish, self._reply,
+                                       bytes([id, STATUS_FINISH]), finish)
+            elif id != BROADCAST_ADDR:
+                res = motor.reply(now, cmd)
+                if res is not None:
+                    self._reply(res, now)
+
+    def _reply(self, data: bytes, now: float):
+        byte_time = self.byte_time()
+        t = max(now + self.response_delay, self._rx_free_at)
+        for b in data:
+            t += byte_time
+            self._rx_pending.append((t, b))
+        self._rx_free_at = t
+        self._schedule_rx()
+
+    def _schedule_rx(self):
+        if self._rx_handle is None and self._rx_pending:
+            self._rx_handle = self._loop.call_at(
+                self._rx_pending[0][0], self._deliver)
+
+    def _deliver(self):
+        self._rx_handle = None
+        if self._closing:
+            return
+        now = self._loop.time()
+        n = 0
+        while n < len(self._rx_pending) and self._rx_pending[n][0] <= now:
+            n += 1
+        data = bytes(b for _, b in self._rx_pending[:n])
+        del self._rx_pending[:n]
+        self._schedule_rx()
+        if data:
+            self.bytes_read += len(data)
+            self._protocol.data_received(data)
+
+
+async def create_sim_connection(loop: asyncio.AbstractEventLoop, protocol_factory: Callable[[], P], motors: Iterable[SimMotor], **kwargs) -> Tuple[SimTransport, P]:
+    """
+    Same as `serial_asyncio.create_serial_connection`, but with simulated
+    controllers instead of a port. See `SimTransport` for the options.
+    """
+    protocol = protocol_factory()
+    transport = SimTransport(loop, protocol, motors, **kwargs)
+    protocol.connection_made(transport)
+    return transport, protocol
@@ -0,0 +1,137 @@
+import asyncio
+from loguru import logger
+from .constant import *
+from .protocol import MotorProtocol
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+# what the poller reads by default
+DEFAULT_KINDS = (READ_POSITION, READ_POSITION_ERROR, READ_ENCODER)
+
+
+class Sample(NamedTuple):
+    # `loop.time()` when the reply arrived
+    time: float
+    # raw value as returned by the controller
+    value: int
+
+
+class SampleRing:
+    """
+    Fixed size ring of the last samples. Only the event loop writes to it, so
+    readers always see a whole sample without any lock.
+    """
+    _buf: List[Optional[Sample]]
+    _next: int
+    _count: int
+
+    def __init__(self, capacity: int = 16) -> None:
+        assert capacity > 0
+        self._buf = [None] * capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def push(self, sample: Sample):
+        self._buf[self._next] = sample
+        self._next = (self._next + 1) % len(self._buf)
+        self._count = min(self._count + 1, len(self._buf))
+
+    def latest(self) -> Optional[Sample]:
+        return self._buf[self._next - 1]
+
+    # oldest first
+    def samples(self) -> List[Sample]:
+        n = len(self._buf)
+        start = self._next - self._count
+        return [self._buf[(start + i) % n] for i in range(self._count)]  # type: ignore
+
+
+class TelemetryPoller:
+    """
+    Round-robin the reads of `kinds` over every added device in the
+    background and keep the samples, so that a controller can take the newest
+    value without touching the serial port.
+
+    `budget` is the fraction of the bus time the poller may take (request and
+    reply on the wire), the rest is left for the commands.
+    """
+    protocol: MotorProtocol
+    kinds: Tuple[int, ...]
+    budget: float
+    # None for the adaptive timeout of `protocol.policy`
+    timeout: Optional[float]
+    capacity: int
+    _ids: List[int]
+    _rings: Dict[Tuple[int, int], SampleRing]
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, protocol: MotorProtocol, ids: Sequence[int] = (), kinds: Sequence[int] = DEFAULT_KINDS, budget: float = 0.5, timeout: Optional[float] = None, capacity: int = 16) -> None:
+        assert 0 < budget <= 1
+        self.protocol = protocol
+        self.kinds = tuple(kinds)
+        self.budget = budget
+        self.timeout = timeout
+        self.capacity = capacity
+        self._ids = []
+        self._rings = {}
+        self._task = None
+        for id in ids:
+            self.add(id)
+
+    def add(self, id: int):
+        if id in self._ids:
+            return
+        self._ids.append(id)
+        for kind in self.kinds:
+            self._rings[(id, kind)] = SampleRing(self.capacity)
+
+    def ring(self, id: int, kind: int = READ_POSITION) -> SampleRing:
+        return self._rings[(id, kind)]
+
+    def latest(self, id: int, kind: int = READ_POSITION) -> Optional[Sample]:
+        return self._rings[(id, kind)].latest()
+
+    def _reader(self, kind: int) -> Callable[..., Awaitable[int]]:
+        return {
+            READ_POSITION: self.protocol.read_position,
+            READ_POSITION_ERROR: self.protocol.read_position_err,
+            READ_ENCODER: self.protocol.read_encoder,
+            READ_INPUT_PULSE_COUNT: self.protocol.read_input_pulse_count,
+        }[kind]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        readers = {kind: self._reader(kind) for kind in self.kinds}
+        while True:
+            # skip the devices whose circuit is open rather than logging a
+            # failure per poll
+            ids = [id for id in self._ids
+                   if self.protocol.policy.available(id)]
+            if not ids:
+                await asyncio.sleep(self.protocol.policy.initial_timeout)
+                continue
+            for id in ids:
+                for kind in self.kinds:
+                    start = loop.time()
+                    try:
+                        value = await readers[kind](id, timeout=self.timeout, max_retry_times=1)
+                        self._rings[(id, kind)].push(Sample(loop.time(), value))
+                    except IOError as e:
+                        logger.warning(
+                            "[{:02x}] poll {:02x} failed: {}".format(id, kind, e))
+                    # stretch the request to the budget
+                    bus_time = (REQUEST_SIZE[kind] + REPLY_SIZE[kind]) * \
+                        self.protocol.byte_time()
+                    idle = bus_time / self.budget - (loop.time() - start)
+                    await asyncio.sleep(max(idle, 0))
+
+    def start(self):
+        self.stop()
+        self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,133 @@
+import asyncio
+import math
+from collections import deque
+from dataclasses import dataclass
+from loguru import logger
+from .constant import SPEED_MAX
+from .motor import PULSE_RATE_PER_SPEED, RotateTiltMotor, degree_to_pulse
+from typing import Deque, Iterable, NamedTuple, Optional, Tuple
+
+
+class Waypoint(NamedTuple):
+    # seconds from the start of the trajectory
+    t: float
+    rotate_deg: float
+    tilt_deg: float
+
+
+@dataclass
+class Segment:
+    # when to send it, seconds from the start of the trajectory
+    at: float
+    rotate_speed: int
+    # signed, positive in the positive direction of the motor
+    rotate_pulse: int
+    tilt_speed: int
+    tilt_pulse: int
+
+
+def speed_for(pulse: int, duration: float) -> int:
+    """
+    the slowest speed level that covers `pulse` within `duration` seconds,
+    at least 1 for any move
+    """
+    if pulse == 0:
+        return 0
+    if duration <= 0:
+        return SPEED_MAX
+    return min(max(math.ceil(abs(pulse) / duration / PULSE_RATE_PER_SPEED), 1), SPEED_MAX)
+
+
+class TrajectoryQueue:
+    """
+    Timed waypoints for a `RotateTiltMotor`.
+
+    The waypoints are turned into pulse/speed segments when they are added
+    (`extend`), so streaming them (`run`) only sends the packets at the right
+    time. Positions are planned in absolute pulses from the position the
+    gimbal had when planning started, so the rounding of the pulses never
+    adds up along the path. Speeds are rounded up, so a segment is done by
+    the time the next one is sent, except for the `saturated` ones: the rest
+    of those is cut short by the next segment and the gimbal lags behind the
+    plan (and its dead reckoning) from there on.
+    """
+    gimbal: RotateTiltMotor
+    # segments whose speed hit SPEED_MAX, i.e. arrive late
+    saturated: int
+    _segments: Deque[Segment]
+    # position (deg) the pulses are counted from
+    _origin: Optional[Tuple[float, float]]
+    # time and absolute pulses of the last planned waypoint
+    _last: Tuple[float, int, int]
+    # `loop.time()` of t = 0
+    _t0: Optional[float]
+    _task: Optional[asyncio.Task]
+
+    def __init__(self, gimbal: RotateTiltMotor) -> None:
+        self.gimbal = gimbal
+        self._segments = deque()
+        self._task = None
+        self.reset()
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    # forget the queued segments; the next `extend` starts a new trajectory
+    # from where the gimbal is
+    def reset(self):
+        self.stop()
+        self._segments.clear()
+        self._origin = None
+        self._last = (0.0, 0, 0)
+        self._t0 = None
+        self.saturated = 0
+
+    def extend(self, waypoints: Iterable[Tuple[float, float, float]]):
+        rotate, tilt = self.gimbal.rotate_motor, self.gimbal.tilt_motor
+        if self._origin is None:
+            assert rotate.last_position_deg is not None and tilt.last_position_deg is not None
+            self._origin = (rotate.last_position_deg, tilt.last_position_deg)
+        origin_r, origin_t = self._origin
+        last_t, last_r, last_ti = self._last
+        for w in map(Waypoint._make, waypoints):
+            assert w.t >= last_t, "waypoints must be in time order"
+            r = degree_to_pulse(rotate._clamp(w.rotate_deg) -
+                                origin_r, rotate.division)
+            ti = degree_to_pulse(tilt._clamp(w.tilt_deg) -
+                                 origin_t, tilt.division)
+            duration = w.t - last_t
+            seg = Segment(last_t,
+                          speed_for(r - last_r, duration), r - last_r,
+                          speed_for(ti - last_ti, duration), ti - last_ti)
+            if SPEED_MAX in (seg.rotate_speed, seg.tilt_speed):
+                self.saturated += 1
+            self._segments.append(seg)
+            last_t, last_r, last_ti = w.t, r, ti
+        self._last = (last_t, last_r, last_ti)
+
+    # send the queued segments on time, until the queue is drained
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        if self._t0 is None:
+            self._t0 = loop.time()
+        rotate, tilt = self.gimbal.rotate_motor, self.gimbal.tilt_motor
+        while self._segments:
+            seg = self._segments.popleft()
+            delay = self._t0 + seg.at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < 0:
+                logger.debug("segment late by {:.2f}ms".format(-delay * 1e3))
+            with rotate.protocol.batch(), tilt.protocol.batch():
+                rotate.move_pulse(seg.rotate_speed, seg.rotate_pulse)
+                tilt.move_pulse(seg.tilt_speed, seg.tilt_pulse)
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
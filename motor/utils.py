@@ -1,16 +1,18 @@
-from datetime import datetime
+from time import perf_counter_ns
 
+
+# monotonic, unlike `datetime.now()`, so it can't jump with the wall clock
 class Instant:
-    time: datetime
+    time: int
 
     def __init__(self) -> None:
-        self.time = datetime.now()
+        self.time = perf_counter_ns()
 
     def elapsed(self) -> float:
-        return (datetime.now() - self.time).total_seconds()
+        return (perf_counter_ns() - self.time) / 1e9
 
     def reset(self) -> None:
-        self.time = datetime.now()
+        self.time = perf_counter_ns()
 
     def elapsed_reset(self) -> float:
         elapsed = self.elapsed()
@@ -7,15 +7,20 @@ import click
 from dataclasses import dataclass
 from datetime import datetime
 from motor.motor import Motor
+from motor.scheduler import FixedRateScheduler
+from motor.capture import CaptureWriter
 
 # https://stackoverflow.com/questions/29269370/how-to-properly-create-and-run-concurrent-tasks-using-pythons-asyncio-module
 @click.command()
 @click.option("--port", "-p", help='Serial port', required=True)
 @click.option("--baudrate", "-b", default=38400, help='Baudrate')
-def main(port: str, baudrate: int):
+@click.option("--frame-gap", default=0.0, help='Idle time between frames in seconds')
+@click.option("--capture", default=None, help='Record the serial traffic to this file')
+def main(port: str, baudrate: int, frame_gap: float, capture: Optional[str]):
     loop = asyncio.get_event_loop()
+    recorder = CaptureWriter(capture) if capture else None
     routine = serial_asyncio.create_serial_connection(
-        loop, MotorProtocol, port, baudrate=baudrate)
+        loop, lambda: MotorProtocol(inter_frame_gap=frame_gap, recorder=recorder), port, baudrate=baudrate)
     protocol: MotorProtocol
     _, protocol = loop.run_until_complete(routine)
     ID = 0xe0
@@ -32,11 +37,13 @@ def main(port: str, baudrate: int):
         await motor.to_degree_with_new_reading(100, 0)
 
         await asyncio.sleep(1)
-        while True:
+
+        async def report_position(dt: float):
             pos = await protocol.read_position(ID)
             pos_deg = (pos / 65536) * 360
             logger.info("pos: {}. deg: {}".format(pos, pos_deg))
-            await asyncio.sleep(2)
+
+        await FixedRateScheduler(0.5, report_position, flush=protocol.flush).run()
 
     loop.create_task(send_test())
     loop.run_forever()
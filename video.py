@@ -4,26 +4,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 import asyncio
 from loguru import logger
-from datetime import datetime
-from typing import Tuple
-
-
-class Instance:
-    time: datetime
-
-    def __init__(self) -> None:
-        self.time = datetime.now()
-
-    def elapsed(self) -> float:
-        return (datetime.now() - self.time).total_seconds()
-
-    def reset(self) -> None:
-        self.time = datetime.now()
-
-    def elapsed_reset(self) -> float:
-        elapsed = self.elapsed()
-        self.reset()
-        return elapsed
+from math import pi
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+from motor.scheduler import FixedRateScheduler
+from camCfg import YUYVFrame
 
 
 Mat = cv2.Mat
@@ -48,60 +32,482 @@ def extractByThresh(image: Mat,
     return blur_again
 
 
-def handle_frame(frame: cv2.Mat) -> cv2.Mat:
-    color_min_red = (10, 144, 121)
-    color_max_red = (245, 255, 152)
-    color_min_green = (18, 60, 135)
-    color_max_green = (245, 108, 255)
-    crop_frame = frame[0:550, 170:740]
-    binary = extractByThresh(crop_frame, color_min_red,
-                             color_max_red)  # type: ignore
+COLOR_MIN_RED = (10, 144, 121)
+COLOR_MAX_RED = (245, 255, 152)
+COLOR_MIN_GREEN = (18, 60, 135)
+COLOR_MAX_GREEN = (245, 108, 255)
+
+
+## the same colour test as a lookup table. A BGR565 pixel (5 bits of blue and
+## red, 6 of green) is a 16 bit index, and the 64k table is small enough to
+## stay in cache, so a frame is thresholded with a colour conversion and one
+## gather instead of a blur, a LAB conversion and an `inRange`
+
+# the (r, g, b) at the middle of every BGR565 cell, in index order, and its
+# LAB. Tables for new ranges are then a single `inRange` over 64k pixels
+_BGR565_RGB = np.stack(np.meshgrid((np.arange(32) << 3) + 4,
+                                   (np.arange(64) << 2) + 2,
+                                   (np.arange(32) << 3) + 4,
+                                   indexing="ij"), axis=-1).reshape(-1, 1, 3).astype(np.uint8)
+_BGR565_LAB = cv2.cvtColor(_BGR565_RGB, cv2.COLOR_RGB2LAB)
+
+# the 3 x 3 square that `(3, 3)` in `extractByThresh` was meant to be
+OPEN_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+
+def build_color_lut(color_min: Tuple[int, int, int],
+                    color_max: Tuple[int, int, int]) -> np.ndarray:
+    """
+    (65536,) table of 0 or 255: whether a BGR565 pixel is within the LAB
+    range, decided at the middle of its cell.
+    """
+    return cv2.inRange(_BGR565_LAB, np.array(color_min), np.array(color_max)).reshape(-1)
+
+
+ColorRange = Tuple[Tuple[int, int, int], Tuple[int, int, int]]
+
+
+def build_class_lut(ranges: Sequence[ColorRange]) -> np.ndarray:
+    """
+    (65536,) table of the class of a BGR565 pixel: 0 for the background,
+    `i + 1` if it is within the LAB range `ranges[i]`. Where ranges overlap
+    the first one wins.
+    """
+    assert len(ranges) < 256
+    table = np.zeros(65536, dtype=np.uint8)
+    for i in reversed(range(len(ranges))):
+        color_min, color_max = ranges[i]
+        table[build_color_lut(color_min, color_max) != 0] = i + 1
+    return table
+
+
+def extractByLUT(image: Mat, lut: np.ndarray, dst=None, scratch=None) -> Mat:
+    """
+    Mask of the pixels whose colour `lut` (from `build_color_lut`) accepts,
+    opened with a 3 x 3 square to remove the isolated pixels. `scratch` is a
+    (h, w, 2) uint8 buffer for the BGR565 image.
+    """
+    bgr565 = cv2.cvtColor(image, cv2.COLOR_BGR2BGR565, dst=scratch)
+    mask = np.take(lut, bgr565.view(np.uint16)[..., 0], out=dst)
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, OPEN_KERNEL, dst=mask)
+
+
+class ColorClassifier:
+    """
+    Every pixel of a frame into background (0) or one of several named LAB
+    ranges (1, 2, ... in order) with one lookup in a `build_class_lut`
+    table, so any number of colours cost one pass. The masks of the classes
+    are then cut out of the class image.
+    """
+
+    def __init__(self, ranges: Dict[str, ColorRange]) -> None:
+        self._shape: Tuple[int, ...] = ()
+        self.set_ranges(ranges)
+
+    def set_ranges(self, ranges: Dict[str, ColorRange]):
+        """new ranges, the table is rebuilt in a few ms"""
+        self.names = list(ranges)
+        self.table = build_class_lut(list(ranges.values()))
+        self._shape = ()
+
+    def _allocate(self, shape: Tuple[int, ...]):
+        h, w = shape[:2]
+        self.bgr565 = np.empty((h, w, 2), dtype=np.uint8)
+        self.classes = np.empty((h, w), dtype=np.uint8)
+        self.masks = {name: np.empty((h, w), dtype=np.uint8) for name in self.names}
+        self._shape = shape
+
+    def classify(self, image: Mat) -> Mat:
+        """(h, w) class of every pixel"""
+        if image.shape != self._shape:
+            self._allocate(image.shape)
+        cv2.cvtColor(image, cv2.COLOR_BGR2BGR565, dst=self.bgr565)
+        return np.take(self.table, self.bgr565.view(np.uint16)[..., 0], out=self.classes)  # type: ignore
+
+    def mask(self, name: str) -> Mat:
+        """opened mask of the class `name` in the last classified frame"""
+        mask = self.masks[name]
+        cv2.compare(self.classes, self.names.index(name) + 1, cv2.CMP_EQ, dst=mask)
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, OPEN_KERNEL, dst=mask)
+
+    def extract(self, image: Mat) -> Dict[str, Mat]:
+        """masks of all the classes in `image`"""
+        self.classify(image)
+        return {name: self.mask(name) for name in self.names}
+
+
+def create_blob_detector(min_area: float, max_area: float) -> cv2.SimpleBlobDetector:
     # https://docs.opencv.org/3.4/d0/d7a/classcv_1_1SimpleBlobDetector.html
     params = cv2.SimpleBlobDetector_Params()
-    from math import pi
     # https://www.geeksforgeeks.org/find-circles-and-ellipses-in-an-image-using-opencv-python/
     params.filterByCircularity = False
     params.filterByConvexity = False
     params.filterByInertia = False
     params.filterByColor = False
     params.filterByArea = True
-    params.minArea = pi * 1 ** 2
-    params.maxArea = pi * 10 ** 2
-    blob = cv2.SimpleBlobDetector_create(params)
-    # blob.filterByArea = True
+    params.minArea = min_area
+    params.maxArea = max_area
     # https://stackoverflow.com/questions/20466676/simpleblobdetector-filtering-by-area
+    return cv2.SimpleBlobDetector_create(params)
+
+
+class MomentSpotDetector:
+    """
+    Drop-in for the `SimpleBlobDetector` of `create_blob_detector` on a
+    single spot: one threshold and one `findContours` pass instead of a
+    contour search at every threshold step. The spots are the outer contours
+    covering [min_area, max_area] pixels, at the centroid of the pixel values
+    inside them, so a smooth mask (or `weights`, an image of the same size
+    such as the luma) gives sub-pixel centers.
+    """
+
+    def __init__(self, min_area: float, max_area: float, threshold: int = 127) -> None:
+        self.min_area = min_area
+        self.max_area = max_area
+        self.threshold = threshold
+        self._shape: Tuple[int, ...] = ()
+
+    def detect(self, image: Mat, weights=None) -> List[cv2.KeyPoint]:
+        if image.shape != self._shape:
+            self.binary = np.empty(image.shape, dtype=np.uint8)
+            self._shape = image.shape
+        if weights is None:
+            weights = image
+        cv2.threshold(image, self.threshold, 255,
+                      cv2.THRESH_BINARY, dst=self.binary)
+        contours, _ = cv2.findContours(
+            self.binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        kps = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            # most of the noise goes here, before anything is drawn
+            if w * h < self.min_area:
+                continue
+            inside = np.zeros((h, w), dtype=np.uint8)
+            cv2.drawContours(inside, [contour], 0, 255, -1, offset=(-x, -y))
+            area = cv2.countNonZero(inside)
+            if not self.min_area <= area <= self.max_area:
+                continue
+            m = cv2.moments(cv2.bitwise_and(
+                weights[y:y + h, x:x + w], weights[y:y + h, x:x + w], mask=inside))
+            if m["m00"] == 0:
+                continue
+            kps.append(cv2.KeyPoint(x + m["m10"] / m["m00"], y + m["m01"] / m["m00"],
+                                    float(2 * np.sqrt(area / pi))))
+        return kps
+
+
+def find_laser_spots(image: Mat) -> List[Tuple[float, float]]:
+    """centers (x, y) of the red laser spots in `image`"""
+    binary = extractByThresh(image, COLOR_MIN_RED,
+                             COLOR_MAX_RED)  # type: ignore
+    blob = create_blob_detector(pi * 1 ** 2, pi * 10 ** 2)
     kps = blob.detect(binary)
-    for kp in kps:
-        x, y = kp.pt
+    return [kp.pt for kp in kps]
+
+
+class LaserSpotDetector:
+    """
+    `find_laser_spots` with everything set up once: the thresholds, the
+    kernel, the blob detector and the intermediate images, which are
+    allocated for the first frame and reused (`dst=`) as long as the frame
+    size doesn't change. Holds state, so one per thread.
+
+    With `lut` the mask comes from `extractByLUT` rather than from the chain
+    of `extractByThresh`. That is a different mask, not the same one faster
+    (a real 3 x 3 opening and no blur): on the synthetic frames of
+    `bench_video.py mask` the two disagree on 3304 of the 4856 pixels set
+    in either, the spots found move by up to 3.7 px (closer to where they
+    were drawn). It hasn't been compared on recorded footage yet
+    (`bench_video.py mask --video test.avi`), so it is opt-in. With
+    `moments` the spots come from a
+    `MomentSpotDetector` rather than from a `SimpleBlobDetector`, weighted
+    by the `channel` of the frame (BGR index, red by default; None for the
+    luma).
+    """
+
+    def __init__(self,
+                 color_min: Tuple[int, int, int] = COLOR_MIN_RED,
+                 color_max: Tuple[int, int, int] = COLOR_MAX_RED,
+                 min_area: float = pi * 1 ** 2,
+                 max_area: float = pi * 10 ** 2,
+                 lut: bool = False,
+                 moments: bool = False,
+                 channel: Optional[int] = 2) -> None:
+        self.lower = np.array(color_min)
+        self.upper = np.array(color_max)
+        self.lut = build_color_lut(color_min, color_max) if lut else None
+        # what `cv2.erode(img, (3, 3))` in `extractByThresh` actually does:
+        # the tuple is taken as a 2 x 1 kernel, not as a 3 x 3 one
+        self.kernel = np.ones((2, 1), dtype=np.uint8)
+        self.detector = MomentSpotDetector(min_area, max_area) if moments \
+            else create_blob_detector(min_area, max_area)
+        self.moments = moments
+        self.channel = channel
+        self._shape: Tuple[int, ...] = ()
+
+    def _allocate(self, shape: Tuple[int, ...]):
+        h, w = shape[:2]
+        self.bgr565 = np.empty((h, w, 2), dtype=np.uint8)
+        self.blur = np.empty((h, w, 3), dtype=np.uint8)
+        self.lab = np.empty((h, w, 3), dtype=np.uint8)
+        self.mask = np.empty((h, w), dtype=np.uint8)
+        self.smooth = np.empty((h, w), dtype=np.uint8)
+        self.weights = np.empty((h, w), dtype=np.uint8)
+        self._shape = shape
+
+    def threshold(self, image: Mat) -> Mat:
+        """`extractByThresh` (or `extractByLUT`), into the detector's buffers"""
+        if image.shape != self._shape:
+            self._allocate(image.shape)
+        if self.lut is not None:
+            return extractByLUT(image, self.lut, self.mask, self.bgr565)
+        cv2.GaussianBlur(image, (5, 5), 2, dst=self.blur, sigmaY=2)
+        cv2.cvtColor(self.blur, cv2.COLOR_BGR2LAB, dst=self.lab)
+        cv2.inRange(self.lab, self.lower, self.upper, dst=self.mask)
+        cv2.erode(self.mask, self.kernel, dst=self.mask, iterations=3)
+        cv2.dilate(self.mask, self.kernel, dst=self.mask, iterations=3)
+        cv2.GaussianBlur(self.mask, (5, 5), 2, dst=self.smooth, sigmaY=2)
+        return self.smooth  # type: ignore
+
+    def detect(self, image: Mat) -> List[Tuple[float, float]]:
+        """centers (x, y) of the laser spots in `image`"""
+        mask = self.threshold(image)
+        if not self.moments:
+            return [kp.pt for kp in self.detector.detect(mask)]
+        if self.channel is None:
+            cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self.weights)
+        else:
+            cv2.extractChannel(image, self.channel, dst=self.weights)
+        return [kp.pt for kp in self.detector.detect(mask, self.weights)]
+
+
+class ColorSpotDetector:
+    """
+    `LaserSpotDetector` for several colours at once, the red and the green
+    laser by default: one `ColorClassifier` pass, then the blobs of each
+    mask. With `moments` the spots of every colour are weighted by the luma.
+    """
+
+    def __init__(self,
+                 ranges: Optional[Dict[str, ColorRange]] = None,
+                 min_area: float = pi * 1 ** 2,
+                 max_area: float = pi * 10 ** 2,
+                 moments: bool = False) -> None:
+        if ranges is None:
+            ranges = {"red": (COLOR_MIN_RED, COLOR_MAX_RED),
+                      "green": (COLOR_MIN_GREEN, COLOR_MAX_GREEN)}
+        self.classifier = ColorClassifier(ranges)
+        self.detector = MomentSpotDetector(min_area, max_area) if moments \
+            else create_blob_detector(min_area, max_area)
+        self.moments = moments
+        self.luma = np.empty((0, 0), dtype=np.uint8)
+
+    def detect(self, image: Mat) -> Dict[str, List[Tuple[float, float]]]:
+        """centers (x, y) of the spots of every colour in `image`"""
+        masks = self.classifier.extract(image)
+        if not self.moments:
+            return {name: [kp.pt for kp in self.detector.detect(mask)]
+                    for name, mask in masks.items()}
+        if self.luma.shape != image.shape[:2]:
+            self.luma = np.empty(image.shape[:2], dtype=np.uint8)
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self.luma)
+        return {name: [kp.pt for kp in self.detector.detect(mask, self.luma)]
+                for name, mask in masks.items()}
+
+
+class Spot(NamedTuple):
+    # (x, y) in the frame, None if the spot is lost
+    pos: Optional[Tuple[float, float]]
+    # "track": found in the window around the prediction; "full": the whole
+    # frame was searched
+    path: str
+
+
+class LaserSpotTracker:
+    """
+    Follows a single laser spot. Between two frames the spot only moves a few
+    pixels, so it is searched in a `window` x `window` square around where it
+    should be (last position plus last displacement). When it isn't in there,
+    or nothing is known yet, the whole frame is searched instead.
+    """
+
+    def __init__(self, window: int = 64, **kwargs) -> None:
+        self.window = window
+        # the window and the whole frame have their own buffers, so neither
+        # reallocates when switching
+        self.near = LaserSpotDetector(**kwargs)
+        self.full = LaserSpotDetector(**kwargs)
+        self.last: Optional[Tuple[float, float]] = None
+        self.velocity = (0.0, 0.0)
+
+    def reset(self):
+        self.last = None
+        self.velocity = (0.0, 0.0)
+
+    def predict(self) -> Optional[Tuple[float, float]]:
+        if self.last is None:
+            return None
+        return self.last[0] + self.velocity[0], self.last[1] + self.velocity[1]
+
+    def _found(self, pos: Tuple[float, float], path: str) -> Spot:
+        if self.last is not None:
+            self.velocity = (pos[0] - self.last[0], pos[1] - self.last[1])
+        self.last = pos
+        return Spot(pos, path)
+
+    @staticmethod
+    def _nearest(spots: List[Tuple[float, float]], to: Tuple[float, float]) -> Tuple[float, float]:
+        return min(spots, key=lambda p: (p[0] - to[0]) ** 2 + (p[1] - to[1]) ** 2)
+
+    def update(self, image: Mat) -> Spot:
+        h, w = image.shape[:2]
+        size = self.window
+        guess = self.predict()
+        if guess is not None and size < w and size < h:
+            # the window keeps its size at the borders, shifted inside
+            x0 = min(max(int(guess[0]) - size // 2, 0), w - size)
+            y0 = min(max(int(guess[1]) - size // 2, 0), h - size)
+            spots = self.near.detect(image[y0:y0 + size, x0:x0 + size])
+            if spots:
+                x, y = self._nearest(spots, (guess[0] - x0, guess[1] - y0))
+                return self._found((x + x0, y + y0), "track")
+        spots = self.full.detect(image)
+        if not spots:
+            self.reset()
+            return Spot(None, "full")
+        return self._found(spots[0] if guess is None else self._nearest(spots, guess), "full")
+
+
+## YUYV frames (`camCfg.YUYVFrame`), straight from the camera: no decode and
+## no colour conversion. The masks are plain 8 bit images, so the blob
+## detector and `findContours` take them as they are
+
+# LAB of the middle of every (Y >> 2, U >> 3, V >> 3) cell, in index order,
+# through the conversion of `YUYVFrame.bgr`: a pixel pair (Y0 U Y1 V) per
+# cell, of which the first pixel is kept
+_YUV_LAB = cv2.cvtColor(np.ascontiguousarray(cv2.cvtColor(
+    np.stack((lambda y, u, v: (y, u, y, v))(*np.meshgrid((np.arange(64) << 2) + 2,
+                                                         (np.arange(32) << 3) + 4,
+                                                         (np.arange(32) << 3) + 4,
+                                                         indexing="ij")),
+             axis=-1).reshape(1, -1, 2).astype(np.uint8),
+    cv2.COLOR_YUV2BGR_YUYV)[:, 0::2]), cv2.COLOR_BGR2LAB).reshape(-1, 1, 3)
+
+
+def build_yuv_lut(color_min: Tuple[int, int, int],
+                  color_max: Tuple[int, int, int]) -> np.ndarray:
+    """
+    `build_color_lut` for YUYV: (65536,) table of 0 or 255, whether a
+    (Y >> 2, U >> 3, V >> 3) pixel is within the LAB range, decided at the
+    middle of its cell. The same colours as the MJPG path.
+    """
+    return cv2.inRange(_YUV_LAB, np.array(color_min), np.array(color_max)).reshape(-1)
+
+
+# the (Y, U, V) of the `_BGR565_RGB` colours as a camera sends them (BT.601
+# limited range, the inverse of `YUYVFrame.bgr`): a pixel pair per colour
+_BGR565_YUV = cv2.cvtColor(np.repeat(_BGR565_RGB, 2, axis=1),
+                           cv2.COLOR_RGB2YUV_YUYV).reshape(-1, 4)[:, [0, 1, 3]]
+
+
+def lab_range_to_yuv(color_min: Tuple[int, int, int],
+                     color_max: Tuple[int, int, int]) -> ColorRange:
+    """
+    The smallest (Y, U, V) box holding the colours within the LAB range,
+    taken at the middle of the BGR565 cells (the ones `build_color_lut`
+    accepts).
+    """
+    yuv = _BGR565_YUV[build_color_lut(color_min, color_max) != 0]
+    return tuple(map(int, yuv.min(axis=0))), tuple(map(int, yuv.max(axis=0)))  # type: ignore
+
+
+RED_YUV_LUT = build_yuv_lut(COLOR_MIN_RED, COLOR_MAX_RED)
+# `OPEN_KERNEL` for the masks of pixel pairs, a column is two pixels wide
+PAIR_OPEN_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 5))
+# for `extractByChroma`. A LAB box isn't a YUV box, so this one takes more
+# colours than `COLOR_MIN_RED`..`COLOR_MAX_RED` (3312 of the table cells
+# against 3170); `extractByYUVLUT` with `RED_YUV_LUT` takes the same ones
+COLOR_MIN_RED_YUV, COLOR_MAX_RED_YUV = lab_range_to_yuv(COLOR_MIN_RED, COLOR_MAX_RED)
+
+
+def extractByLuma(frame: YUYVFrame, y_min: int, y_max: int = 255) -> Mat:
+    # the 2 channel buffer as is, any chroma goes
+    return cv2.inRange(frame.data, (y_min, 0), (y_max, 255))  # type: ignore
+
+
+def extractByChroma(frame: YUYVFrame,
+                    color_min: Tuple[int, int, int],
+                    color_max: Tuple[int, int, int],
+                    ) -> Mat:
+    """
+    Mask of the pixel pairs (Y0 U Y1 V) whose colour is in range, at the
+    resolution of the chroma: (h, w / 2).
+    """
+    y_min, u_min, v_min = color_min
+    y_max, u_max, v_max = color_max
+    return cv2.inRange(frame.pairs, (y_min, u_min, y_min, v_min),  # type: ignore
+                       (y_max, u_max, y_max, v_max))
+
+
+def extractByYUVLUT(frame: YUYVFrame, lut: np.ndarray) -> Mat:
+    """
+    `extractByChroma` with a `build_yuv_lut` table: mask of the pixel pairs
+    whose two pixels are in range, (h, w / 2), opened like `extractByLUT`
+    with a 3 x 5 rectangle (about 6 x 5 pixels of the frame).
+    """
+    pairs = frame.pairs
+    uv = ((pairs[..., 1] >> 3).astype(np.uint16) << 5) | (pairs[..., 3] >> 3)
+    mask = np.take(lut, ((pairs[..., 0] >> 2).astype(np.uint16) << 10) | uv)
+    mask &= np.take(lut, ((pairs[..., 2] >> 2).astype(np.uint16) << 10) | uv)
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, PAIR_OPEN_KERNEL, dst=mask)
+
+
+def find_laser_spots_yuyv(frame: YUYVFrame) -> List[Tuple[float, float]]:
+    """`find_laser_spots` on a YUYV frame, in pixels of the frame"""
+    mask = extractByYUVLUT(frame, RED_YUV_LUT)
+    # a column of the mask is two pixels wide
+    blob = create_blob_detector(pi * 1 ** 2 / 2, pi * 10 ** 2 / 2)
+    return [(2 * x + 0.5, y) for x, y in (kp.pt for kp in blob.detect(mask))]
+
+
+# the `extractByThresh` mask and the `SimpleBlobDetector`, as before the
+# tracker. `LaserSpotTracker(lut=True, moments=True)` opts into the LUT mask
+# and the weighted sub-pixel centers, see `LaserSpotDetector`
+spot_tracker = LaserSpotTracker()
+
+
+def handle_frame(frame: cv2.Mat) -> cv2.Mat:
+    crop_frame = frame[0:550, 170:740]
+    spot = spot_tracker.update(crop_frame)
+    if spot.pos is not None:
+        x, y = spot.pos
         cv2.circle(crop_frame, (int(x), int(y)), 10, (0, 0, 255), -1)
-        logger.info(f"Found blob at {x}, {y}")
+        logger.info(f"Found blob at {x}, {y} ({spot.path})")
 
     ret = crop_frame
     return ret  # type: ignore
 
 
 async def runVideo():
-    frame_instance = Instance()
     fps = 30
-    duration_ms = (1 / fps) * 1000
     cap = cv2.VideoCapture("test.avi")
-    while True:
+    scheduler: FixedRateScheduler
+
+    def tick(dt: float):
         ret, frame = cap.read()
-        if ret:
-            r = handle_frame(frame)
-            cv.imshow("frame", r)
-            if cv.waitKey(1) & 0xFF == ord('q'):
-                exit()
-            elapsed = frame_instance.elapsed()
-            diff = duration_ms - elapsed
-            if diff < 0:
-                logger.warning(
-                    f"Frame took {elapsed}ms, which is longer than {duration_ms}ms")
-            await asyncio.sleep(diff / 1000)
-            frame_instance.reset()
-        else:
+        if not ret:
             logger.warning("No frame")
             exit()
+        r = handle_frame(frame)
+        cv.imshow("frame", r)
+        if cv.waitKey(1) & 0xFF == ord('q'):
+            exit()
+        if scheduler.stats.ticks % fps == 0:
+            logger.info("{}", scheduler.stats)
+
+    scheduler = FixedRateScheduler(fps, tick)
+    await scheduler.run()
 
 
 def main():